@@ -0,0 +1,363 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import numpy as np
+
+from encoding import WIN_SIZE, one_hot_batch
+from fasta_io import write_fasta
+
+'''
+Micro-benchmarks for the inference pipeline, and an end to end benchmark suite (synthetic
+GFF3 / transcripts FASTA / rG4-seq CSV inputs at several scales, every stage timed, JSON report)
+'''
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+CSV_DATA_DIR = os.path.join(CODE_DIR, 'prepare_rg4_data', 'csv_data')
+SUITE_CHROMS = ['chr1', 'chr2', 'chrX']
+SUITE_SCALES = [1000, 10000, 100000]
+GENE_SPAN = 5000
+
+
+def random_seqs(n, min_len=100, max_len=160, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_len, max_len + 1, size=n)
+    letters = np.frombuffer(b'ACGTN', dtype=np.uint8)
+    return [letters[rng.integers(0, 5, size=l)].tobytes().decode() for l in lengths]
+
+
+def timeit(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = time()
+        res = func()
+        elapsed = time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def bench_one_hot(n, repeat):
+    from g4_inference import oneHot
+
+    seqs = random_seqs(n)
+    t_ref, ref = timeit(lambda: np.array(list(map(oneHot, seqs))), repeat)
+    t_new, new = timeit(lambda: one_hot_batch(seqs), repeat)
+    assert ref.dtype == new.dtype and np.array_equal(ref, new), "one_hot_batch differs from oneHot"
+    print(f"oneHot        : {t_ref:.3f}s ({n / t_ref:,.0f} seqs/s)")
+    print(f"one_hot_batch : {t_new:.3f}s ({n / t_new:,.0f} seqs/s)")
+    print(f"speedup       : {t_ref / t_new:.1f}x, outputs identical")
+
+
+def stand_in_model(input_len, seed):
+    from tensorflow import keras
+
+    keras.utils.set_random_seed(seed)
+    return keras.Sequential([keras.Input((input_len, 4)),
+                             keras.layers.Conv1D(32, 12, activation='relu'),
+                             keras.layers.GlobalMaxPooling1D(),
+                             keras.layers.Dense(16, activation='relu'),
+                             keras.layers.Dense(1)])
+
+
+def bench_ensemble(n, repeat, size=11, input_len=30, batch_size=1024):
+    from model_registry import fuse_ensemble
+
+    models = [stand_in_model(input_len, i) for i in range(size)]
+    fused = fuse_ensemble(models)
+    x = np.random.default_rng(0).integers(0, 2, size=(n, input_len, 4)).astype(np.float32)
+
+    def list_predict():
+        return np.mean([m.predict(x, batch_size=batch_size, verbose=0) for m in models], axis=0)
+
+    t_list, ref = timeit(list_predict, repeat)
+    t_fused, new = timeit(lambda: fused.predict(x, batch_size=batch_size, verbose=0), repeat)
+    assert np.allclose(ref, new, atol=1e-5), f"fused ensemble differs, max diff {np.abs(ref - new).max()}"
+    print(f"list of {size} models : {t_list:.3f}s ({n / t_list:,.0f} windows/s)")
+    print(f"fused ensemble      : {t_fused:.3f}s ({n / t_fused:,.0f} windows/s)")
+    print(f"speedup             : {t_list / t_fused:.1f}x, max abs diff {np.abs(ref - new).max():.2e}")
+
+
+def write_synthetic_gff(path, n_genes, rnd):
+    """
+    GENCODE like GFF3 of n_genes genes (1-6 transcripts of 1-8 exons each, some on scaffolds that are
+    filtered out). Returns [(transcript_id, chrom, strand, exons)] with exons in transcript order.
+    """
+    chrom_len = max(1000000, n_genes * 3000)
+    transcripts = []
+    lines = ["##gff-version 3", "#description: synthetic benchmark annotation"]
+    for g in range(n_genes):
+        chrom = "GL000009.2" if g % 50 == 49 else SUITE_CHROMS[(g // 2) % len(SUITE_CHROMS)]
+        strand = "+-"[g % 2]
+        gs = rnd.randint(1, chrom_len)
+        gid = f"ENSG{g:011d}.1"
+        lines.append(f"{chrom}\tHAVANA\tgene\t{gs}\t{gs + GENE_SPAN}\t.\t{strand}\t.\t"
+                     f"ID={gid};gene_id={gid};gene_type=protein_coding;")
+        for k in range(rnd.randint(1, 6)):
+            tid = f"ENST{g:06d}{k:05d}.1"
+            n_exons = rnd.randint(1, 8)
+            pts = sorted(rnd.sample(range(gs, gs + GENE_SPAN), n_exons * 2))
+            tsl = rnd.choice(["1", "2", "3", "NA", None])
+            tsl_attr = f"transcript_support_level={tsl};" if tsl else ""
+            lines.append(f"{chrom}\tHAVANA\ttranscript\t{pts[0]}\t{pts[-1]}\t.\t{strand}\t.\t"
+                         f"ID={tid};Parent={gid};gene_id={gid};transcript_id={tid};{tsl_attr}tag=basic")
+            exons = [(pts[2 * j], pts[2 * j + 1]) for j in range(n_exons)]
+            if strand == "-":
+                exons = exons[::-1]
+            for j, (a, b) in enumerate(exons):
+                lines.append(f"{chrom}\tHAVANA\texon\t{a}\t{b}\t.\t{strand}\t.\t"
+                             f"ID=exon:{tid}:{j};Parent={tid};gene_id={gid};transcript_id={tid};exon_number={j + 1};")
+            transcripts.append((tid, chrom, strand, exons))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return transcripts
+
+
+def write_synthetic_transcripts(path, transcripts, seed):
+    # GENCODE style transcripts fasta (60 nt lines) of random sequences with the exonic lengths
+    rng = np.random.default_rng(seed)
+    letters = np.frombuffer(b"ACGTacgt", dtype=np.uint8)
+    headers, seqs = [], []
+    for tid, _, _, exons in transcripts:
+        length = sum(b - a + 1 for a, b in exons)
+        seq = letters[rng.integers(0, len(letters), size=length)].tobytes().decode()
+        headers.append(f"{tid}|ENSG|OTTHUMG|OTTHUMT|name|gene|{length}|protein_coding|")
+        seqs.append("\n".join(seq[i:i + 60] for i in range(0, length, 60)))
+    write_fasta(path, headers, seqs)
+
+
+def write_synthetic_rg4_csv(path, transcripts, n, rnd):
+    # rG4-seq like positions, 80% inside annotated exons and the rest anywhere on the chromosome
+    standard = [t for t in transcripts if t[1] in SUITE_CHROMS]
+    rows = []
+    for _ in range(n):
+        _, chrom, strand, exons = rnd.choice(standard)
+        if rnd.random() < 0.8:
+            a, b = rnd.choice(exons)
+            pos = rnd.randint(a, b)
+        else:
+            pos = rnd.randint(1, exons[0][0] + GENE_SPAN)
+        t_read, c_read = rnd.randint(1, 3000), rnd.randint(1, 3000)
+        rows.append((chrom, pos, rnd.random() * 3, t_read, c_read, t_read + c_read, strand))
+    rows.sort(key=lambda r: (r[0], r[6], r[1]))
+    with open(path, "w") as f:
+        f.write("chromosome,position,rsr,t_read,c_read,total_reads,strand\n")
+        f.write("".join(f"{c},{p},{r},{t},{cr},{tr},{s}\n" for c, p, r, t, cr, tr, s in rows))
+
+
+def _reset_peak_rss():
+    # Linux: reset the VmHWM high water mark, so every stage reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # process lifetime peak (kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _stage(stages, name, func, items):
+    """
+    Run func (silencing its prints) and record wall time, throughput and peak RSS under stages[name].
+    items: number of processed items, or a function of func's result
+    """
+    _reset_peak_rss()
+    t = time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        res = func()
+    elapsed = time() - t
+    n = items(res) if callable(items) else items
+    stages[name] = {"seconds": round(elapsed, 4), "items": n,
+                    "items_per_s": round(n / elapsed, 1) if elapsed > 0 else None,
+                    "peak_rss_mb": round(_peak_rss_mb(), 1)}
+    print(f"{name:>20}: {elapsed:8.3f}s  {n / max(elapsed, 1e-9):>14,.0f} items/s  "
+          f"{stages[name]['peak_rss_mb']:8.1f} MB")
+    return res
+
+
+def run_scale(n, work_dir, seed=0, max_plot=20000):
+    """
+    Build the synthetic inputs of n rG4-seq positions in work_dir and time every pipeline stage.
+    Runs in its own process, so peak RSS and import costs do not leak between scales.
+    """
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    sys.path.insert(0, CSV_DATA_DIR)
+    import extract_most_prominent_transcript as annotation
+    from annotation_cache import AnnotationCache
+    from csv2seq import extract_windows, map_locations, transcript_id
+    from fasta_io import FastaIndex
+    import metrics
+    import plot_generator
+
+    print(f"scale {n:,} positions")
+    os.makedirs(work_dir, exist_ok=True)
+    gff, fasta, csv = (os.path.join(work_dir, name) for name in ("syn.gff3", "transcripts.fa", "test_data.csv"))
+    cache_dir = os.path.join(work_dir, "transcripts_locations")
+    stages = {}
+    rnd = random.Random(seed)
+
+    def generate():
+        transcripts = write_synthetic_gff(gff, max(50, n // 20), rnd)
+        write_synthetic_transcripts(fasta, transcripts, seed)
+        write_synthetic_rg4_csv(csv, transcripts, n, rnd)
+        return transcripts
+    transcripts = _stage(stages, "generate_inputs", generate, n)
+
+    n_transcripts = len(transcripts)
+    _stage(stages, "gff_parse", lambda: annotation.read_gff_transcripts(gff), lambda n_lines: n_lines)
+    _stage(stages, "transcript_sort", annotation.sort_transcripts, n_transcripts)
+    _stage(stages, "annotation_cache", lambda: annotation.write_transcripts_cache(gff, cache_dir), n_transcripts)
+
+    data_df = pd.read_csv(csv)
+    tr_data_df = _stage(stages, "position_mapping",
+                        lambda: map_locations(data_df, cache_dir, AnnotationCache(cache_dir), {}), n)
+
+    index = _stage(stages, "fasta_index", lambda: FastaIndex(fasta, key=transcript_id), n_transcripts)
+    seqs = _stage(stages, "window_extraction", lambda: extract_windows(tr_data_df, index), len(tr_data_df))
+    index.close()
+
+    x = _stage(stages, "one_hot", lambda: one_hot_batch(seqs), len(seqs))
+    model = stand_in_model(WIN_SIZE, seed)
+    model.predict(x[:1], verbose=0)  # graph tracing is not part of the stage
+    pred = _stage(stages, "predict", lambda: model.predict(x, batch_size=1024, verbose=0).reshape(-1), len(x))
+
+    # metrics and plots through the plot_generator file formats
+    tr_csv, pred_csv = os.path.join(work_dir, "test_tr_data.csv"), os.path.join(work_dir, "g4_prediction.csv")
+    label_csv, rg4_pred_csv = os.path.join(work_dir, "test.csv"), os.path.join(work_dir, "rg4_prediction.csv")
+    tr_data_df.to_csv(tr_csv, index=False)
+    pd.Series(pred, name="predicted").to_csv(pred_csv, index=False)
+    pd.DataFrame({"seq": seqs, "label": (tr_data_df["rsr"].to_numpy(dtype=float) > 1.5).astype(int)}).to_csv(
+        label_csv, index=False)
+    pd.DataFrame({"description": tr_data_df["transcript"], "rG4detector prediction": pred}).to_csv(
+        rg4_pred_csv, index=False)
+
+    def evaluate():
+        rsr, g4_prob = metrics.read_g4_on_rg4(tr_csv, pred_csv)
+        metrics.summary_table({"g4_on_rg4": {("K", "bench"): (rsr, g4_prob)},
+                               "rg4_on_g4": {("K", "bench"): metrics.read_rg4_on_g4(label_csv, rg4_pred_csv)}})
+        roc = plot_generator.calc_rg4detector_on_g4detector(label_csv, rg4_pred_csv, "K", "bench")
+        return rsr, g4_prob, roc
+    rsr, g4_prob, roc = _stage(stages, "metrics", evaluate, len(pred))
+
+    m = min(len(pred), max_plot)
+    plot_dir = os.path.join(work_dir, "plots") + "/"
+    os.makedirs(plot_dir, exist_ok=True)
+
+    def plots():
+        plot_generator.plt_auroc({"K_bench": roc}, "K", plot_dir)
+        plot_generator.plt_scatter_density({"K_bench": g4_prob[:m]}, rsr[:m], plot_dir)
+        plt.close("all")
+    _stage(stages, "plots", plots, m)
+    return {"scale": n, "transcripts": n_transcripts, "windows": len(seqs), "plot_points": m, "stages": stages}
+
+
+def scaling_exponents(results):
+    """
+    Empirical exponent k of time ~ scale^k of every stage between consecutive scales
+    (about 1 for linear stages, 2 for quadratic ones).
+    """
+    exponents = {}
+    for a, b in zip(results, results[1:]):
+        for stage, rec in b["stages"].items():
+            t_a, t_b = a["stages"][stage]["seconds"], rec["seconds"]
+            n_a, n_b = a["stages"][stage]["items"], rec["items"]
+            if min(t_a, t_b) > 1e-3 and n_b > n_a > 0:
+                exponents.setdefault(stage, []).append(round(math.log(t_b / t_a) / math.log(n_b / n_a), 2))
+    return exponents
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CODE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(report, baseline_path):
+    # time ratio of every stage against a previous report, for the scales both have
+    with open(baseline_path) as f:
+        old_report = json.load(f)
+    baseline = {r["scale"]: r for r in old_report["results"]}
+    print(f"\ncompared to {baseline_path} (commit {old_report['meta']['commit']}): time ratio new/old")
+    for res in report["results"]:
+        old = baseline.get(res["scale"])
+        if old is None:
+            continue
+        for stage, rec in res["stages"].items():
+            if stage in old["stages"] and old["stages"][stage]["seconds"] > 0:
+                ratio = rec["seconds"] / old["stages"][stage]["seconds"]
+                # stages of a few ms are mostly noise
+                flag = "  <-- slower" if ratio > 1.25 and old["stages"][stage]["seconds"] >= 0.05 else ""
+                print(f"{res['scale']:>10,} {stage:>20}: {ratio:6.2f}x{flag}")
+
+
+def bench_suite(scales, out_path, work_dir=None, seed=0, max_plot=20000, baseline=None):
+    """
+    Run run_scale for every scale (each in a fresh process) and write the JSON report to out_path.
+    """
+    report = {"meta": {"commit": _git_commit(), "time": round(time()), "python": platform.python_version(),
+                       "platform": platform.platform(), "cpus": os.cpu_count(), "seed": seed,
+                       "max_plot": max_plot},
+              "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = work_dir or tmp
+        for n in sorted(scales):
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as pool:
+                res = pool.submit(run_scale, n, os.path.join(work_dir, f"scale_{n}"), seed, max_plot).result()
+            report["results"].append(res)
+    report["scaling"] = scaling_exponents(report["results"])
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"\nscaling exponents (time ~ n^k): {report['scaling']}")
+    print(f"report written to {out_path}")
+    if baseline:
+        compare_reports(report, baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['one_hot', 'ensemble', 'suite'], help='Benchmark to run')
+    parser.add_argument('-n', '--num', default=20000, type=int, help='Number of sequences (default 20000)')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='Repetitions, best time is reported (default 3)')
+    parser.add_argument('--scales', nargs='+', default=SUITE_SCALES, type=int,
+                        help=f'suite: numbers of rG4-seq positions to run (default {SUITE_SCALES})')
+    parser.add_argument('-o', '--out', default='benchmark.json', help='suite: JSON report path (default benchmark.json)')
+    parser.add_argument('--work-dir', dest='work_dir', help='suite: keep the synthetic inputs here (default temporary)')
+    parser.add_argument('--max-plot', dest='max_plot', default=20000, type=int,
+                        help='suite: max number of points in the density plot (default 20000)')
+    parser.add_argument('--baseline', help='suite: previous JSON report to compare stage times with')
+    args = parser.parse_args()
+
+    if args.bench == 'one_hot':
+        bench_one_hot(args.num, args.repeat)
+    elif args.bench == 'ensemble':
+        bench_ensemble(args.num, args.repeat)
+    elif args.bench == 'suite':
+        bench_suite(args.scales, args.out, args.work_dir, max_plot=args.max_plot, baseline=args.baseline)
@@ -0,0 +1,102 @@
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+from seq_store import META_FILE as STORE_META_FILE, is_store
+
+'''
+Checkpoints of chunked inference runs, so an interrupted run resumes instead of starting over.
+A checkpoint is a directory with:
+    shard_<i>.npz  - the arrays saved for chunk i (written atomically)
+    manifest.json  - input file stamp, chunk size, run tag and the finished chunks
+The manifest is rewritten after every shard, a shard that is not listed in it is recomputed.
+'''
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def source_stamp(path):
+    # a sequence store is stamped by its meta file, which is written last when the store is built
+    stat_path = os.path.join(path, STORE_META_FILE) if is_store(path) else path
+    st = os.stat(stat_path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def _atomic_write(path, write):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    """
+    Shards and manifest of one chunked run over source.
+    tag: string identifying everything else the results depend on (model, options); resuming with a
+    different source, chunk size or tag is refused.
+    Usage: iterate the chunks through pending(), which skips finished chunks, and call save() with the
+    results of every chunk it yields, in order. Once all chunks are finished, shards() yields the
+    saved results of all chunks in order.
+    """
+    def __init__(self, ckpt_dir, source, chunk_size, tag=''):
+        self.dir = ckpt_dir
+        os.makedirs(ckpt_dir, exist_ok=True)
+        manifest = {'source': source_stamp(source), 'chunk_size': chunk_size, 'tag': tag,
+                    'n_chunks': None, 'done': []}
+        manifest_path = os.path.join(ckpt_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                saved = json.load(f)
+            for key in ('source', 'chunk_size', 'tag'):
+                assert saved[key] == manifest[key], \
+                    f"Checkpoint {ckpt_dir} belongs to another run ({key} changed), remove it or use another directory"
+            manifest = saved
+        self.manifest = manifest
+        self.done = set(manifest['done'])
+        self._queue = deque()
+
+    @property
+    def complete(self):
+        n = self.manifest['n_chunks']
+        return n is not None and len(self.done) == n
+
+    def _shard_path(self, i):
+        return os.path.join(self.dir, f'shard_{i:06d}.npz')
+
+    def _write_manifest(self):
+        self.manifest['done'] = sorted(self.done)
+        data = json.dumps(self.manifest).encode()
+        _atomic_write(os.path.join(self.dir, MANIFEST_FILE), lambda f: f.write(data))
+
+    def pending(self, chunks):
+        """
+        Yield the chunks that are not finished yet (finished ones are still read, but not yielded).
+        May run on a pipeline producer thread, the manifest is only written by save() and shards().
+        """
+        if self.done:
+            print(f"Resuming from {self.dir}, {len(self.done)} chunks already done")
+        n = 0
+        for i, chunk in enumerate(chunks):
+            n = i + 1
+            if i not in self.done:
+                self._queue.append(i)
+                yield chunk
+        self.manifest['n_chunks'] = n
+
+    def save(self, **arrays):
+        """
+        Save the results of the oldest chunk yielded by pending() and mark it done.
+        """
+        i = self._queue.popleft()
+        _atomic_write(self._shard_path(i), lambda f: np.savez(f, **arrays))
+        self.done.add(i)
+        self._write_manifest()
+
+    def shards(self):
+        assert self.complete, f"Checkpoint {self.dir} is incomplete"
+        self._write_manifest()
+        for i in range(self.manifest['n_chunks']):
+            with np.load(self._shard_path(i)) as shard:
+                yield {name: shard[name] for name in shard.files}
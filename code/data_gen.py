@@ -1,84 +1,49 @@
 import argparse
+import os
 
 import pandas as pd
-import numpy as np
 
+from fasta_io import read_fasta, write_fasta
+
+HOLDOUT_CHROMS = ('chr1',)
+
+
+def read_g4_fasta(path):
+    """
+    Parse a G4 benchmark fasta file (headers like >chr1:1000-1125) into a DataFrame of
+    upper case sequences and their chromosome.
+    """
+    headers, seqs = read_fasta(path)
+    data = pd.DataFrame({'seq': seqs, 'chrom': headers})
+    # splitting into chromosome number and window, selecting only chromosome number
+    data['chrom'] = data['chrom'].str.split(':', n=1).str[0]
+    data['seq'] = data['seq'].str.upper()
+    return data
+
+
+def split_holdout(data, label, holdout=HOLDOUT_CHROMS):
+    """
+    Filter out sequences containing N and split into (train, test) frames by the holdout chromosomes,
+    both labeled with label, in one vectorized pass.
+    """
+    data = data[~data['seq'].str.contains('N', regex=False)]
+    is_test = data['chrom'].isin(holdout).to_numpy()
+    train = pd.DataFrame({'seq': data['seq'][~is_test].to_numpy(), 'label': label})
+    test = pd.DataFrame({'seq': data['seq'][is_test].to_numpy(), 'label': label})
+    return train, test
 
-def read_files(pos_f, neg_f):
-    # reading from files
-    pos = pd.read_csv(pos_f, header=None)[0]
-    neg = pd.read_csv(neg_f, header=None)[0]
-
-    # filtering out_g4detector_on_rg4_data chromosome lines
-    chrom = pos[pos.str.contains(">")]
-
-    # splitting into chromosome number and window
-    chrom = chrom.str.split(':', expand=True)
-
-    header = ['chrom', 'window']
-    chrom.columns = header
-
-    # selecting only chromosome number and reseting index
-    chrom = chrom.chrom.reset_index(drop=True)
-
-    # filtering out_g4detector_on_rg4_data sequence lines and reseting index
-    reads = pos[~pos.str.contains(">")]
-    reads = reads.reset_index(drop=True)
-
-    # making new dataframe of positive examples
-    pos = pd.DataFrame({'seq': reads, 'chrom': chrom})
-
-    # repeating process for negative examples
-    chrom = neg[neg.str.contains(">")]
-    chrom = chrom.str.split(':', expand=True)
-    header = ['chrom', 'window']
-    chrom.columns = header
-    chrom = chrom.chrom.reset_index(drop=True)
-
-    reads = neg[~neg.str.contains(">")]
-    reads = reads.reset_index(drop=True)
-
-    neg = pd.DataFrame({'seq': reads, 'chrom': chrom})
-
-    # preparing positive set
-    p = pos[pos.chrom != '>chr1'].seq  # filtering out_g4detector_on_rg4_data chr1
-    p = p.str.upper()
-    p = p[~p.str.contains("N")]
-    p.reset_index(drop=True, inplace=True)
-    lp = np.ones(p.shape[0])
-
-    # chromosome 1 test set
-    cp = pos[pos.chrom == '>chr1'].seq  # selecting chr1
-    cp = cp.str.upper()
-    cp = cp[~cp.str.contains("N")]
-    cp.reset_index(drop=True, inplace=True)
-    lcp = np.ones(cp.shape[0])
-
-    # negative set
-    n = neg[neg.chrom != '>chr1'].seq  # filtering out_g4detector_on_rg4_data chr1
-    n = n.str.upper()
-    n = n[~n.str.contains("N")]
-    n.reset_index(drop=True, inplace=True)
-    ln = np.zeros(n.shape[0])
 
-    # chromosome 1 test set (negative)
-    cn = neg[neg.chrom == '>chr1'].seq  # selecting chr1
-    cn = cn.str.upper()
-    cn = cn[~cn.str.contains("N")]
-    cn.reset_index(drop=True, inplace=True)
-    lcn = np.zeros(cn.shape[0])
+def read_files(pos, neg_f, holdout=HOLDOUT_CHROMS):
+    # positive (already parsed, shared by all negative types) and negative sets,
+    # split into train and the holdout chromosomes test set
+    p, cp = split_holdout(pos, 1, holdout)
+    n, cn = split_holdout(read_g4_fasta(neg_f), 0, holdout)
 
     # join and mix
-    x = pd.concat([p, n])
-    y = np.hstack([lp, ln])
-    y = y.astype('int')
-    train = pd.DataFrame({'seq': x, 'label': y})
+    train = pd.concat([p, n], ignore_index=True)
     train = train.sample(frac=1).reset_index(drop=True)
 
-    test_x = pd.concat([cp, cn])
-    test_y = np.hstack([lcp, lcn])
-    test_y = test_y.astype('int')
-    test = pd.DataFrame({'seq': test_x, 'label': test_y})
+    test = pd.concat([cp, cn], ignore_index=True)
     test = test.sample(frac=1).reset_index(drop=True)
 
     return train, test
@@ -89,19 +54,24 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data', dest="data_path", help='Path to G4 data directory that contains K and KPDS dir with pos and neg data'
                         , type=str)
 
-    parser.add_argument('-o', '--out', dest="out_path", help='Output path', type=str)
+    parser.add_argument('-o', '--out', dest="out_path", help='Output directory', type=str)
+    parser.add_argument('--holdout', nargs='+', default=list(HOLDOUT_CHROMS),
+                        help='Test set chromosomes held out of training (default chr1)')
+    parser.add_argument('--gzip', action='store_true', help='gzip compress the output files')
     args = parser.parse_args()
 
     environment = ['KPDS', 'K']
     negative_type = ['dishuffle', 'pq', 'random']
+    suffix = '.gz' if args.gzip else ''
+    os.makedirs(args.out_path, exist_ok=True)
     for env in environment:
+        # the positive set is parsed once per environment
+        pos = read_g4_fasta(args.data_path + f'/{env}/pos_ex_{env}_125.fa')
         for neg in negative_type:
-            pos_f = args.data_path + f'/{env}/pos_ex_{env}_125.fa'
             neg_f = args.data_path + f'../g4_data_prep/{env}/neg_ex_{env}_{neg}_125.fa'
-            train, test = read_files(pos_f, neg_f)
+            train, test = read_files(pos, neg_f, tuple(args.holdout))
             test['seq'] = 'NNN' + test['seq'].astype(str) + 'NNN'
-            with open(args.out_path + "test.fa", 'w+') as f:
-                for i, s in enumerate(test['seq']):
-                    header = ' '
-                    f.write(f">{header}\n{s}\n")
-            test.to_csv(args.out_path + '/test.csv', index=False, sep=',')
+            # one test set per environment and negative type
+            name = os.path.join(args.out_path, f'test_{env}_{neg}')
+            write_fasta(f'{name}.fa{suffix}', [' '] * len(test), test['seq'])
+            test.to_csv(f'{name}.csv{suffix}', index=False, sep=',')
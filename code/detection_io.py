@@ -0,0 +1,121 @@
+import csv
+
+import numpy as np
+import pandas as pd
+
+from fasta_io import WRITE_BUFFER_SIZE, open_text
+
+'''
+Per-position detection results (predict_fasta.py -d) of many sequences, held as one ragged array: the scores of
+all the sequences concatenated, with an offsets index (scores of sequence i = scores[offsets[i]:offsets[i + 1]]).
+Output formats:
+    csv  - the original layout, two rows per sequence (description + nucleotides, then the scores)
+    npz  - descriptions, offsets and float32 scores arrays, loaded without any text parsing
+    tsv  - long format gzip TSV, one description / position / score row per position (records are told apart
+           by their position 0 row, so every record needs at least one score)
+'''
+
+DETECTION_FORMATS = ['csv', 'npz', 'tsv']
+DETECTION_FILES = {'csv': 'detection.csv', 'npz': 'detection.npz', 'tsv': 'detection.tsv.gz'}
+
+
+class Detection:
+    """
+    Ragged per-position scores of a set of sequences.
+    Records are looked up by index or description: detection[i], detection['seq1'].
+    """
+    def __init__(self, descriptions, offsets, scores):
+        assert len(offsets) == len(descriptions) + 1, f"{len(offsets)} offsets for {len(descriptions)} sequences"
+        self.descriptions = list(descriptions)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.scores = np.asarray(scores)
+        self._index = None
+
+    @classmethod
+    def from_scores(cls, descriptions, scores):
+        # scores: per sequence score arrays (any lengths)
+        lengths = np.fromiter((len(s) for s in scores), dtype=np.int64, count=len(scores))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.concatenate(scores) if len(scores) else np.empty(0, dtype=np.float32)
+        return cls(descriptions, offsets, flat)
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, np.integer)):
+            if self._index is None:
+                self._index = {desc: i for i, desc in enumerate(self.descriptions)}
+            key = self._index[key]
+        return self.scores[self.offsets[key]:self.offsets[key + 1]]
+
+    def items(self):
+        for i, desc in enumerate(self.descriptions):
+            yield desc, self.scores[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_frame(self):
+        """
+        Long format DataFrame: description, position (0-based) and score of every position.
+        """
+        lengths = self.lengths
+        record = np.repeat(np.arange(len(self)), lengths)
+        position = np.arange(len(self.scores)) - self.offsets[:-1][record]
+        description = np.array(self.descriptions, dtype=object)[record]
+        return pd.DataFrame({'description': description, 'position': position, 'score': self.scores})
+
+
+def write_detection(path, detection, fmt, seqs=None):
+    """
+    Write detection to path in fmt (one of DETECTION_FORMATS), seqs are needed by the csv format only.
+    """
+    if fmt == 'csv':
+        assert seqs is not None, "The csv detection format needs the sequences"
+        with open(path, 'w') as f:
+            write = csv.writer(f)
+            for (desc, pred), seq in zip(detection.items(), seqs):
+                write.writerow([desc] + [n for n in seq])
+                write.writerow([""] + list(pred))
+    elif fmt == 'npz':
+        np.savez(path, descriptions=np.array(detection.descriptions, dtype=str), offsets=detection.offsets,
+                 scores=detection.scores.astype(np.float32))
+    elif fmt == 'tsv':
+        empty = np.flatnonzero(detection.lengths == 0)
+        if len(empty):
+            raise ValueError(f"Record {detection.descriptions[empty[0]]} has no scores, the tsv detection format "
+                             f"cannot hold it (use npz or csv)")
+        # one formatted block per record, much faster than DataFrame.to_csv over the long table
+        with open_text(path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+            write = f.write
+            write("description\tposition\tscore\n")
+            for desc, pred in detection.items():
+                write("".join([f"{desc}\t{i}\t{s:.6g}\n" for i, s in enumerate(pred.tolist())]))
+    else:
+        raise ValueError(f"Unknown detection format {fmt}, expected one of {DETECTION_FORMATS}")
+
+
+def read_detection(path):
+    """
+    Load a detection file written by write_detection (the format is taken from the file name).
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return Detection(f['descriptions'].tolist(), f['offsets'], f['scores'])
+    if path.endswith(('.tsv', '.tsv.gz')):
+        df = pd.read_csv(path, sep='\t', dtype={'description': str, 'position': np.int64, 'score': np.float32},
+                         keep_default_na=False)
+        # rows are written record by record, a record starts at position 0
+        starts = np.flatnonzero(df['position'].to_numpy() == 0)
+        offsets = np.append(starts, len(df))
+        return Detection(df['description'].to_numpy()[starts].tolist(), offsets, df['score'].to_numpy())
+    descriptions, scores = [], []
+    with open(path) as f:
+        rows = csv.reader(f)
+        for desc_row in rows:
+            descriptions.append(desc_row[0])
+            scores.append(np.array(next(rows)[1:], dtype=np.float64))
+    return Detection.from_scores(descriptions, scores)
@@ -0,0 +1,171 @@
+import numpy as np
+
+'''
+Batch one-hot encoding of nucleotide sequences for the G4detector model
+'''
+
+WIN_SIZE = 124
+PAD_CODE = 4
+BLOCK_SIZE = 1 << 16
+
+# byte -> class index (A, C, G, T, N/Z), everything else is invalid
+CODE_LUT = np.full(256, 255, dtype=np.uint8)
+for _i, _chars in enumerate(('Aa', 'Cc', 'Gg', 'Tt', 'NnZz')):
+    for _c in _chars:
+        CODE_LUT[ord(_c)] = _i
+
+# class index -> one-hot row, N/Z is all zeros
+ONE_HOT_TABLE = np.vstack([np.eye(4, dtype=np.uint8), np.zeros((1, 4), dtype=np.uint8)])
+
+
+def _as_buffer(seqs):
+    """
+    Return (buffer, offsets, lengths) for a list of str/bytes or a NumPy 'S'/'U' array,
+    with all sequences laid out in one flat uint8 buffer.
+    """
+    if isinstance(seqs, np.ndarray):
+        if seqs.dtype.kind == 'U':
+            seqs = seqs.astype('S')
+        assert seqs.dtype.kind == 'S', f"Unsupported array dtype {seqs.dtype}"
+        seqs = np.ascontiguousarray(seqs)
+        width = seqs.dtype.itemsize
+        buf = seqs.view(np.uint8).reshape(-1)
+        offsets = np.arange(len(seqs), dtype=np.int64) * width
+        lengths = np.char.str_len(seqs).astype(np.int64)
+        return buf, offsets, lengths
+
+    seqs = list(seqs)
+    if seqs and isinstance(seqs[0], bytes):
+        joined = b'\n'.join(seqs)
+    else:
+        joined = '\n'.join(seqs).encode('ascii')
+    buf = np.frombuffer(joined, dtype=np.uint8)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    offsets = np.zeros(len(seqs), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 1, out=offsets[1:])
+    return buf, offsets, lengths
+
+
+def crop_pad_coords(lengths, win=WIN_SIZE):
+    """
+    Same center-crop / N-pad arithmetic as g4_inference.oneHot (Python round() is
+    round-half-to-even, as is np.round). Returns (src_start, dst_start, copy_len).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    pwin = round(win/2)
+    src_start = np.zeros_like(lengths)
+    dst_start = np.zeros_like(lengths)
+    copy_len = np.minimum(lengths, win)
+
+    long_seq = lengths > win
+    src_start[long_seq] = np.round(lengths[long_seq] / 2).astype(np.int64) - pwin
+
+    short_seq = lengths < win
+    dst_start[short_seq] = np.round((win - lengths[short_seq]) / 2).astype(np.int64)
+    return src_start, dst_start, copy_len
+
+
+def _fill_blocks(buf, offsets, lengths, win, out, one_hot):
+    src_start, dst_start, copy_len = crop_pad_coords(lengths, win)
+    cols = np.arange(win, dtype=np.int64)
+    last = max(len(buf) - 1, 0)
+
+    for b in range(0, len(lengths), BLOCK_SIZE):
+        e = min(b + BLOCK_SIZE, len(lengths))
+        rel = cols - dst_start[b:e, None]
+        valid = (rel >= 0) & (rel < copy_len[b:e, None])
+        idx = offsets[b:e, None] + src_start[b:e, None] + rel
+        np.clip(idx, 0, last, out=idx)
+        codes = CODE_LUT[buf[idx]] if len(buf) else np.full(idx.shape, PAD_CODE, dtype=np.uint8)
+        codes[~valid] = PAD_CODE
+        bad = (codes == 255).any(axis=1)
+        if bad.any():
+            raise ValueError(f"Invalid nucleotide in sequence {b + int(np.argmax(bad))}")
+        if one_hot:
+            np.take(ONE_HOT_TABLE, codes, axis=0, out=out[b:e])
+        else:
+            out[b:e] = codes
+    return out
+
+
+def encode_codes(seqs, win=WIN_SIZE, out=None):
+    """
+    Center-crop / N-pad every sequence to win and return (n, win) uint8 class codes
+    (0-3 for ACGT, 4 for N/Z padding).
+    """
+    buf, offsets, lengths = _as_buffer(seqs)
+    if out is None:
+        out = np.empty((len(lengths), win), dtype=np.uint8)
+    return _fill_blocks(buf, offsets, lengths, win, out, one_hot=False)
+
+
+def one_hot_batch(seqs, win=WIN_SIZE, out=None):
+    """
+    Vectorized replacement for np.array(list(map(oneHot, seqs))).
+    Encodes a list of sequences (or a NumPy bytes array) into one preallocated
+    (n, win, 4) uint8 tensor, block by block, without per-sequence allocations.
+    """
+    buf, offsets, lengths = _as_buffer(seqs)
+    if out is None:
+        out = np.empty((len(lengths), win, 4), dtype=np.uint8)
+    return _fill_blocks(buf, offsets, lengths, win, out, one_hot=True)
+
+
+def codes_to_one_hot(codes, out=None):
+    """
+    Expand (n, win) uint8 class codes into an (n, win, 4) uint8 one-hot tensor.
+    """
+    if out is None:
+        out = np.empty(codes.shape + (4,), dtype=np.uint8)
+    np.take(ONE_HOT_TABLE, codes, axis=0, out=out)
+    return out
+
+
+def unique_windows(codes):
+    """
+    Deduplicate (n, win) class codes: return (first, inverse), the index of the first occurrence of
+    every distinct window and the window of every row, so codes[first][inverse] == codes.
+    """
+    codes = np.ascontiguousarray(codes)
+    rows = codes.view(f'V{codes.shape[1]}').ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+
+def encode_range(seq, start, end):
+    """
+    One-hot encode seq[start:end] as an (end - start, 4) uint8 array for scanning, positions outside the
+    sequence (start < 0 or end > len(seq)) are N-padding.
+    """
+    codes = np.full(end - start, PAD_CODE, dtype=np.uint8)
+    a, b = max(start, 0), min(end, len(seq))
+    if b > a:
+        part = CODE_LUT[np.frombuffer(seq[a:b].encode('ascii'), dtype=np.uint8)]
+        bad = part == 255
+        if bad.any():
+            raise ValueError(f"Invalid nucleotide at position {a + int(np.argmax(bad))}")
+        codes[a - start:b - start] = part
+    return codes_to_one_hot(codes)
+
+
+def scan_window_count(length, win=WIN_SIZE, stride=1):
+    # windows tiling a sequence of length every stride positions, the last one ending at its end
+    last = max(length - win, 0)
+    return last // stride + 1 + (last % stride > 0)
+
+
+def window_starts(length, first, stop, win=WIN_SIZE, stride=1):
+    """
+    Starts of the scanned windows first .. stop-1 of a sequence of length, relative to the sequence.
+    A sequence shorter than win has one window, N-padded like oneHot (negative start).
+    """
+    if length < win:
+        return np.full(stop - first, -round((win - length) / 2), dtype=np.int64)
+    return np.minimum(np.arange(first, stop, dtype=np.int64) * stride, length - win)
+
+
+def scan_windows(x, win=WIN_SIZE):
+    """
+    (L - win + 1, win, 4) read-only view of every window of the (L, 4) one-hot x, no window is copied.
+    """
+    return np.lib.stride_tricks.sliding_window_view(x, win, axis=0).transpose(0, 2, 1)
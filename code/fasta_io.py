@@ -0,0 +1,187 @@
+import gzip
+import os
+import re
+from itertools import islice
+
+'''
+Lightweight FASTA reading and writing helpers shared by the inference and data preparation scripts
+'''
+
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def open_text(path, mode='r', buffering=-1):
+    # Open either as .gz or as text file.
+    if re.search(r".+\.gz$", path):
+        return gzip.open(path, mode + 't', compresslevel=6)
+    return open(path, mode, buffering=buffering)
+
+
+def iter_fasta(path):
+    """
+    Lazily yield (description, sequence) pairs from a FASTA file, one record at a time.
+    Multi-line sequences are joined, anything before the first header is ignored.
+    """
+    with open_text(path) as f:
+        desc, lines = None, []
+        for line in f:
+            if line.startswith('>'):
+                if desc is not None:
+                    yield desc, ''.join(lines)
+                desc, lines = line[1:].rstrip(), []
+            elif desc is not None:
+                lines.append(line.strip().replace(' ', ''))
+        if desc is not None:
+            yield desc, ''.join(lines)
+
+
+def read_fasta(path, upper=False):
+    """
+    Read a whole FASTA file in one pass and return (descriptions, sequences) lists.
+    Files in the simple one-line-per-sequence layout are split directly without a per-record
+    parsing loop, anything else falls back to iter_fasta.
+    """
+    with open_text(path) as f:
+        lines = f.read().splitlines()
+    while lines and not lines[-1].strip():
+        lines.pop()
+    headers, seqs = lines[0::2], lines[1::2]
+    simple = len(headers) == len(seqs) and all(h.startswith('>') for h in headers) and \
+        not any(s.startswith('>') for s in seqs)
+    if simple:
+        descs = [h[1:].rstrip() for h in headers]
+        # same normalisation as iter_fasta
+        seqs = [s.strip().replace(' ', '') for s in seqs]
+    else:
+        del lines, headers, seqs
+        records = list(iter_fasta(path))
+        descs = [d for d, _ in records]
+        seqs = [s for _, s in records]
+    if upper:
+        seqs = [s.upper() for s in seqs]
+    return descs, seqs
+
+
+def write_fasta(path, headers, seqs):
+    """
+    Write the records of two equal length columns (lists, arrays or Series) to a FASTA file through
+    a large write buffer. A path ending with .gz is gzip compressed.
+    """
+    assert len(headers) == len(seqs), f"{len(headers)} headers for {len(seqs)} sequences"
+    with open_text(path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        write = f.write
+        for desc, seq in zip(headers, seqs):
+            write(f">{desc}\n{seq}\n")
+
+
+def write_lines(path, lines):
+    """
+    Write one item per line through a large write buffer. A path ending with .gz is gzip compressed.
+    """
+    with open_text(path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        write = f.write
+        for line in lines:
+            write(f"{line}\n")
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of at most size items from iterable.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class FastaIndex:
+    """
+    faidx style random access to a (plain text) FASTA file.
+    The samtools compatible index (name, length, offset, line bases, line width) is built once and
+    cached next to the FASTA as <fasta>.fai, then records and subranges are read with seeks only.
+    key: optional function mapping a record name (first word of the header) to the lookup key. Records
+    mapped to the same key (e.g. the ENST..._PAR_Y copies of chrX transcripts in GENCODE) are counted in
+    duplicates and the last one is kept.
+    """
+    def __init__(self, path, key=None):
+        assert not path.endswith(".gz"), f"Indexed access needs an uncompressed FASTA file: {path}"
+        self.path = path
+        fai_path = path + ".fai"
+        if not os.path.exists(fai_path) or os.path.getmtime(fai_path) < os.path.getmtime(path):
+            build_fai(path, fai_path)
+        self.records = {}
+        self.duplicates = 0
+        with open(fai_path) as f:
+            for line in f:
+                name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+                rec_key = key(name) if key else name
+                self.duplicates += rec_key in self.records
+                self.records[rec_key] = (int(length), int(offset), int(line_bases), int(line_width))
+        if self.duplicates:
+            print(f"{self.duplicates} records of {path} share their key with an earlier record, the last one is kept")
+        self._f = open(path, "rb")
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def length(self, key):
+        return self.records[key][0]
+
+    def fetch(self, key, start=0, end=None):
+        """
+        Sequence of record key in the 0-based half open range [start, end).
+        """
+        length, offset, line_bases, line_width = self.records[key]
+        end = length if end is None else min(end, length)
+        start = max(0, start)
+        if start >= end:
+            return ""
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+        self._f.seek(first)
+        raw = self._f.read(last - first + 1)
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_fai(path, fai_path):
+    # records must have equal line lengths (except their last line), like samtools faidx requires
+    entries = []
+    with open(path, "rb") as f:
+        name, length, offset, line_bases, line_width, short_line = None, 0, 0, 0, 0, False
+        pos = 0
+        for line in f:
+            line_len = len(line)
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.append((name, length, offset, line_bases, line_width))
+                name = line[1:].split()[0].decode()
+                length, offset, line_bases, line_width, short_line = 0, pos + line_len, 0, 0, False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases:
+                    if line_bases == 0:
+                        line_bases, line_width = bases, line_len
+                    elif short_line or bases > line_bases:
+                        raise ValueError(f"Different line length in sequence {name} of {path}")
+                    short_line = short_line or bases < line_bases
+                    length += bases
+            pos += line_len
+        if name is not None:
+            entries.append((name, length, offset, line_bases, line_width))
+    with open(fai_path, "w") as f:
+        f.write("".join(f"{n}\t{l}\t{o}\t{b}\t{w}\n" for n, l, o, b, w in entries))
@@ -10,12 +10,31 @@ seed(1)
 from tensorflow.random import set_seed
 set_seed(2)
 import sys
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from time import time
 import argparse
+import json
 import numpy as np
 import pandas as pd
 from keras.utils import to_categorical
 from keras.models import load_model
+from encoding import one_hot_batch, codes_to_one_hot, encode_codes, unique_windows, encode_range, scan_window_count, \
+    scan_windows, window_starts, WIN_SIZE
+from fasta_io import iter_fasta, chunked
+from pipeline import run_pipeline, StageTimer, DedupStats
+from seq_store import SeqStore, is_store
+from checkpoint import Checkpoint, source_stamp
+from model_registry import weights_hash
+from prediction_cache import PredictionCache
 
+SCAN_BATCH = 65536
+PREDICT_BATCH = 1024
+WRITE_BLOCK = 65536
+SCAN_AGGREGATES = ['max', 'mean']
+REGION_RE = re.compile(r'^(\S+):(\d+)-(\d+)')
 
 def oneHot(string, win=124):
     if len(string) > win:
@@ -24,7 +43,7 @@ def oneHot(string, win=124):
         string = string[c-pwin:c+pwin]
     elif len(string) < win:
         z1 = round((win - len(string))/2)
-        z2 = win - z1
+        z2 = win - len(string) - z1
         string = 'N'*z1 + string + 'N'*z2
 		
     trantab = str.maketrans('ACGTNZ', '012344')
@@ -44,23 +63,319 @@ def read_files(path, window=125):
 
 def user_input():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--data', help='Path to fasta file. of rG4 data', type=str)
+    parser.add_argument('-d', '--data', help='Path to fasta file. of rG4 data (or a sequence store built by seq_store.py)',
+                        type=str)
     parser.add_argument('-m', '--model', help='Path to model. from G4detector project', type=str)
     parser.add_argument('-o', '--out', help='Output path', type=str)
+    parser.add_argument('--stream', action='store_true',
+                        help='Read, encode and predict the fasta file in chunks with bounded memory')
+    parser.add_argument('--chunk-size', dest='chunk_size', default=100000, type=int,
+                        help='Number of sequences per chunk in stream mode (default 100000)')
+    parser.add_argument('--workers', default=2, type=int,
+                        help='Number of encoder threads in stream and scan mode (default 2)')
+    parser.add_argument('--queue-depth', dest='queue_depth', default=4, type=int,
+                        help='Max number of encoded chunks waiting for prediction in stream and scan mode (default 4)')
+    parser.add_argument('--checkpoint', help='Checkpoint directory: save every predicted chunk there (stream mode) '
+                                             'and resume an interrupted run from it', type=str)
+    parser.add_argument('--cache', help='Prediction cache file (SQLite): windows scored before by the same model are '
+                                        'not predicted again', type=str)
+    parser.add_argument('--cache-size', dest='cache_size', default=1024, type=float,
+                        help='Prediction cache size limit in MB, least recently used predictions are evicted (default 1024)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Predict every distinct encoded window once and copy its prediction to the duplicates')
+    parser.add_argument('--scan', action='store_true',
+                        help='Scan whole sequences with sliding windows instead of scoring their center window; '
+                             'per-position tracks are written to <out>_<aggregate>.bedGraph')
+    parser.add_argument('--stride', default=1, type=int,
+                        help=f'Window stride in scan mode, 1 to {WIN_SIZE} (default 1)')
+    parser.add_argument('--aggregate', nargs='+', default=SCAN_AGGREGATES, choices=SCAN_AGGREGATES,
+                        help='Per-position aggregates of the covering windows written in scan mode (default max mean)')
+    parser.add_argument('--scan-batch', dest='scan_batch', default=SCAN_BATCH, type=int,
+                        help=f'Number of windows scored together in scan mode (default {SCAN_BATCH})')
 
     args = parser.parse_args()
     arguments = vars(args)
 
     return arguments
 
+
+def load_store(path):
+    store = SeqStore(path)
+    assert store.win == WIN_SIZE, f"Sequence store was encoded with win={store.win}, G4detector needs {WIN_SIZE}"
+    return store
+
+
+def open_cache(args, model):
+    # cached predictions are keyed by the model weights and the encoded window
+    if not args['cache']:
+        return None
+    return PredictionCache(args['cache'], f"G4detector {weights_hash(model)}", args['cache_size'])
+
+
+def cached_predict(model, cache, codes, x):
+    # only windows that are not in the cache reach the model
+    if cache is None:
+        return model.predict(x, verbose=0)
+    return cache.predict(codes, lambda idx: model.predict(x[idx], verbose=0))
+
+
+def encode_windows(codes, dedup=None):
+    # model input of the windows, with dedup stats only of the distinct ones (inverse scatters them back)
+    inverse = None
+    if dedup is not None:
+        first, inverse = unique_windows(codes)
+        dedup.add(len(codes), len(first))
+        codes = codes[first]
+    return codes, codes_to_one_hot(codes), inverse
+
+
+def predict_windows(model, cache, codes, x, inverse=None):
+    pred = cached_predict(model, cache, codes, x)
+    return pred if inverse is None else pred[inverse]
+
+
+def stream_predict(model, data_path, out_path, chunk_size, workers=2, queue_depth=4, checkpoint=None, cache=None,
+                   dedup=None):
+    # parsing and encoding of the next chunks overlap with prediction of the current one,
+    # predictions are appended to the output file chunk by chunk
+    # (with a checkpoint, they are saved as shards first and merged into the output at the end)
+    n = 0
+    timer = StageTimer()
+    if is_store(data_path):
+        # pre-encoded store, only the one-hot expansion is left per chunk
+        chunks, encode = load_store(data_path).code_chunks(chunk_size), codes_to_one_hot
+    else:
+        chunks, encode = chunked((seq for _, seq in iter_fasta(data_path)), chunk_size), one_hot_batch
+    predict = lambda x: model.predict(x, verbose=0)
+    if cache is not None or dedup is not None:
+        # the encoded windows are the cache and dedup keys
+        from_store = is_store(data_path)
+        encode = lambda chunk: encode_windows(chunk if from_store else encode_codes(chunk), dedup)
+        predict = lambda windows: predict_windows(model, cache, *windows)
+    if checkpoint is not None:
+        chunks = checkpoint.pending(chunks)
+    results = run_pipeline(chunks, encode, predict, workers=workers, queue_depth=queue_depth, timer=timer)
+    if checkpoint is not None:
+        for chunk, pred in results:
+            checkpoint.save(predicted=pred.reshape(-1))
+        preds = (shard['predicted'] for shard in checkpoint.shards())
+    else:
+        preds = (pred.reshape(-1) for chunk, pred in results)
+    with open(out_path, 'w') as f:
+        for i, pred in enumerate(preds):
+            pd.Series(pred, name='predicted').to_csv(f, index=False, header=(i == 0))
+            n += len(pred)
+    print(f"Number of sequences = {n}")
+    print(timer.report())
+    if dedup is not None:
+        print(dedup.report())
+    if cache is not None:
+        print(cache.report())
+
+
+def region(desc):
+    # chrom and start of a bedtools getfasta style "chrom:start-end" record, anything else starts at 0
+    m = REGION_RE.match(desc)
+    return (m.group(1), int(m.group(2))) if m else ((desc.split() or [desc])[0], 0)
+
+
+def window_tracks(starts, pred, length, win=WIN_SIZE, begin=0):
+    """
+    Per-position max and mean of the scores pred of the windows at starts (ascending, relative to the sequence)
+    over the positions begin .. length-1, as runs of positions covered by the same windows:
+    (run starts, run ends, max, mean). Positions no window covers (stride > win) are left out.
+    """
+    ends = starts + win
+    bounds = np.unique(np.clip(np.concatenate([starts, ends, [begin, length]]), begin, length))
+    run_start, run_end = bounds[:-1], bounds[1:]
+    # windows lo .. hi-1 cover the run: they start at or before it and end after it
+    lo = np.searchsorted(ends, run_start, side='right')
+    hi = np.searchsorted(starts, run_start, side='right')
+    covered = hi > lo
+    run_start, run_end, lo, hi = run_start[covered], run_end[covered], lo[covered], hi[covered]
+    pred = pred.astype(np.float64)
+    csum = np.concatenate([[0.0], np.cumsum(pred)])
+    mean = (csum[hi] - csum[lo]) / (hi - lo)
+    # range max over pred[lo:hi] from a sparse table: table holds the max of every 2^j consecutive windows
+    track_max = np.empty(len(run_start))
+    level = np.log2(hi - lo).astype(np.int64) if len(run_start) else np.empty(0, dtype=np.int64)
+    table = pred
+    for j in range(int(level.max(initial=-1)) + 1):
+        if j:
+            table = np.maximum(table[:-(1 << (j - 1))], table[1 << (j - 1):])
+        sel = level == j
+        track_max[sel] = np.maximum(table[lo[sel]], table[hi[sel] - (1 << j)])
+    return run_start, run_end, track_max, mean
+
+
+def merge_runs(run_start, run_end, values):
+    # join adjacent runs of equal value (e.g. the max track is flat around a peak)
+    new = np.concatenate([[True], (values[1:] != values[:-1]) | (run_start[1:] != run_end[:-1])])
+    last = np.concatenate([new[1:], [True]])
+    return run_start[new], run_end[last], values[new]
+
+
+def write_bedgraph(f, chrom, run_start, run_end, values):
+    # formatted in blocks of WRITE_BLOCK lines
+    line = chrom.replace('%', '%%') + '\t%d\t%d\t%.6g\n'
+    for i in range(0, len(values), WRITE_BLOCK):
+        j = i + WRITE_BLOCK
+        f.write(''.join(map(line.__mod__, zip(run_start[i:j].tolist(), run_end[i:j].tolist(), values[i:j].tolist()))))
+
+
+def scan_chunks(data_path, stride, batch_size):
+    """
+    Split the windows of all the sequences into chunks of batch_size windows: lists of pieces
+    (record number, description, sequence, first window, stop window, number of windows of the sequence).
+    Short sequences share a chunk, long ones are split over several.
+    """
+    chunk, size = [], 0
+    for rec, (desc, seq) in enumerate(iter_fasta(data_path)):
+        if not seq:
+            continue
+        n = scan_window_count(len(seq), WIN_SIZE, stride)
+        first = 0
+        while first < n:
+            stop = min(n, first + batch_size - size)
+            chunk.append((rec, desc, seq, first, stop, n))
+            size += stop - first
+            first = stop
+            if size == batch_size:
+                yield chunk
+                chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def encode_scan_chunk(chunk, stride):
+    """
+    Model input of a chunk of scan_chunks: only the part of a sequence its windows cover is encoded, and the
+    windows are gathered from a strided view over it straight into the batch.
+    """
+    x = np.empty((sum(stop - first for _, _, _, first, stop, _ in chunk), WIN_SIZE, 4), dtype=np.uint8)
+    pos = 0
+    for _, _, seq, first, stop, _ in chunk:
+        starts = window_starts(len(seq), first, stop, WIN_SIZE, stride)
+        view = scan_windows(encode_range(seq, int(starts[0]), int(starts[-1]) + WIN_SIZE))
+        np.take(view, starts - starts[0], axis=0, out=x[pos:pos + len(starts)])
+        pos += len(starts)
+    return x
+
+
+class TrackWriter:
+    """
+    Aggregates the window scores of consecutive scan_chunks pieces into per-position tracks. A range of positions
+    is written as soon as all windows covering it are scored; the windows still overlapping the rest of the
+    sequence are carried over to the next piece.
+    """
+    def __init__(self, tracks, stride):
+        self.tracks = tracks
+        self.stride = stride
+        self.record = None
+
+    def add(self, piece, pred):
+        rec, desc, seq, first, stop, n = piece
+        length = len(seq)
+        if rec != self.record:
+            self.record, self.done = rec, 0
+            self.chrom, self.base = region(desc)
+            self.starts, self.pred = np.empty(0, dtype=np.int64), np.empty(0, dtype=pred.dtype)
+        starts = np.concatenate([self.starts, window_starts(length, first, stop, WIN_SIZE, self.stride)])
+        pred = np.concatenate([self.pred, pred])
+        # later windows start at or after limit, positions before it are final
+        limit = length if stop == n else int(window_starts(length, stop, stop + 1, WIN_SIZE, self.stride)[0])
+        run_start, run_end, track_max, mean = window_tracks(starts, pred, limit, WIN_SIZE, self.done)
+        values = {'max': track_max, 'mean': mean}
+        for agg, f in self.tracks.items():
+            write_bedgraph(f, self.chrom, *merge_runs(run_start + self.base, run_end + self.base, values[agg]))
+        carry = starts + WIN_SIZE > limit
+        self.starts, self.pred, self.done = starts[carry], pred[carry], limit
+
+    def add_chunk(self, chunk, pred):
+        i = 0
+        for piece in chunk:
+            k = piece[4] - piece[3]
+            self.add(piece, pred[i:i + k])
+            i += k
+
+
+def scan_predict(model, data_path, out_prefix, stride=1, aggregates=SCAN_AGGREGATES, batch_size=SCAN_BATCH,
+                 workers=2, queue_depth=4):
+    """
+    Score every window of stride tiling the sequences of data_path and write the per-position aggregates of the
+    windows covering every position to out_prefix_<aggregate>.bedGraph.
+    Memory is bounded by the chunk size (batch_size windows) and the queue depths, not by the sequence lengths:
+    windows are encoded in background threads (as in stream mode) and the tracks are aggregated and written on
+    a writer thread, while the model predicts the next chunk.
+    """
+    timer = StageTimer()
+    n_windows = 0
+    chunks = scan_chunks(data_path, stride, batch_size)
+    encode = lambda chunk: encode_scan_chunk(chunk, stride)
+    predict = lambda x: model.predict(x, verbose=0, batch_size=PREDICT_BATCH).reshape(-1)
+
+    def write(writer, chunk, pred):
+        t = time()
+        writer.add_chunk(chunk, pred)
+        timer.add('write', time() - t, len(chunk))
+
+    with ExitStack() as stack:
+        tracks = {agg: stack.enter_context(open(f'{out_prefix}_{agg}.bedGraph', 'w')) for agg in aggregates}
+        for agg, f in tracks.items():
+            f.write(f'track type=bedGraph name="G4detector {agg}" description="G4detector {agg} window score, '
+                    f'stride {stride}"\n')
+        writer = TrackWriter(tracks, stride)
+        # one writer thread keeps the pieces in order, at most queue_depth chunks wait for it
+        write_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        pending = deque()
+        for chunk, pred in run_pipeline(chunks, encode, predict, workers=workers, queue_depth=queue_depth, timer=timer):
+            n_windows += len(pred)
+            pending.append(write_pool.submit(write, writer, chunk, pred))
+            while len(pending) > queue_depth or (pending and pending[0].done()):
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    print(f"Number of windows = {n_windows}")
+    print(timer.report())
+    if timer.seconds['predict'] > 0:
+        print(f"{n_windows / timer.seconds['predict']:,.0f} windows/s")
+
+
 def main():
     args = user_input()
-    data = read_files(args['data'])
-    x = np.array(list(map(oneHot, list(data[0]))))
+    if args['scan']:
+        assert not (args['stream'] or args['checkpoint'] or args['cache'] or args['dedup']), \
+            "--scan does not combine with --stream, --checkpoint, --cache or --dedup"
+        assert 1 <= args['stride'] <= WIN_SIZE, f"--stride must be between 1 and {WIN_SIZE}, larger strides leave gaps"
+        model = load_model(args['model'])
+        scan_predict(model, args['data'], args['out'], args['stride'], args['aggregate'], args['scan_batch'],
+                     args['workers'], args['queue_depth'])
+        return
+    if args['stream'] or args['checkpoint']:
+        checkpoint = None
+        if args['checkpoint']:
+            # results depend on the model file as well as on the input and the chunking
+            checkpoint = Checkpoint(args['checkpoint'], args['data'], args['chunk_size'],
+                                    tag=json.dumps(source_stamp(args['model'])))
+        model = load_model(args['model'])
+        stream_predict(model, args['data'], args['out'], args['chunk_size'], args['workers'], args['queue_depth'],
+                       checkpoint, open_cache(args, model), DedupStats() if args['dedup'] else None)
+        return
     model = load_model(args['model'])
-    pred = model.predict(x)
-    data['predicted'] = pred.squeeze()
-    data['predicted'].to_csv(args['out'], index=False)
+    cache = open_cache(args, model)
+    dedup = DedupStats() if args['dedup'] else None
+    if is_store(args['data']):
+        codes = load_store(args['data']).codes
+    else:
+        codes = encode_codes(list(read_files(args['data'])[0]))
+    codes, x, inverse = encode_windows(codes, dedup)
+    pred = model.predict(x) if cache is None else cached_predict(model, cache, codes, x)
+    if dedup is not None:
+        pred = pred[inverse]
+        print(dedup.report())
+    if cache is not None:
+        print(cache.report())
+    pd.Series(pred.reshape(-1), name='predicted').to_csv(args['out'], index=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr, spearmanr
+
+'''
+Evaluation metrics of the cross predictions (rG4detector on G4 data, G4detector on rG4 data) for all
+environment / negative type combinations: AUROC, AUPRC, Pearson and Spearman, with optional bootstrap
+confidence intervals, in one summary table.
+All metrics take (resamples, n) sample weights, so the bootstrap resamples of a pair are scored together.
+'''
+
+ENVIRONMENTS = ['K', 'KPDS']
+NEGATIVE_TYPES = ['dishuffle', 'pq', 'random']
+BOOTSTRAP_BLOCK = 64
+LABEL_DIR = 'data_out_g4detector_label'
+
+
+def rg4_on_g4_paths(data_path, env, neg):
+    # G4detector test set labels (data_gen.py output directory) and rG4detector predictions (predict_fasta.py)
+    label_path = os.path.join(data_path, LABEL_DIR, f'test_{env}_{neg}.csv')
+    if not os.path.exists(label_path) and os.path.exists(label_path + '.gz'):
+        # data_gen.py --gzip
+        label_path += '.gz'
+    return (label_path,
+            os.path.join(data_path, f'out_rg4detector_on_g4_data/rG4detector_prediction_{env}_{neg}.csv'))
+
+
+def g4_on_rg4_paths(data_path, env, neg):
+    # rG4-seq transcript data (csv2seq.py) and G4detector predictions (g4_inference.py)
+    return (os.path.join(data_path, 'test_tr_data.csv'),
+            os.path.join(data_path, f'out_g4detector_on_rg4_data/G4detector_prediction_{env}_{neg}.csv'))
+
+
+def _aligned(origin, preds, origin_path, preds_path):
+    # prediction files are written in the order of the test set rows, they are aligned by row number
+    assert len(origin) == len(preds), \
+        f"{preds_path} has {len(preds)} predictions for the {len(origin)} rows of {origin_path}"
+    return origin, preds
+
+
+def read_column(path, last=False):
+    """
+    The first (or last) column of a csv file with a header row as float64, picked by position: the header
+    of the prediction files varies (e.g. "predicted]" in older G4detector outputs).
+    """
+    col = len(pd.read_csv(path, nrows=0).columns) - 1 if last else 0
+    return pd.read_csv(path, header=0, usecols=[col], dtype=np.float64).iloc[:, 0].to_numpy()
+
+
+def read_rg4_on_g4(label_path, preds_path):
+    labels = pd.read_csv(label_path, usecols=['label'], dtype={'label': np.float64})['label'].to_numpy()
+    # description, prediction
+    preds = read_column(preds_path, last=True)
+    return _aligned(labels, preds, label_path, preds_path)
+
+
+def read_g4_on_rg4(tr_data_path, preds_path, rsr=None):
+    # rsr: the already loaded rsr column of tr_data_path (shared by all the prediction files)
+    if rsr is None:
+        rsr = pd.read_csv(tr_data_path, usecols=['rsr'], dtype={'rsr': np.float64})['rsr'].to_numpy()
+    preds = read_column(preds_path)
+    return _aligned(rsr, preds, tr_data_path, preds_path)
+
+
+def load_pairs(data_path, task, envs=ENVIRONMENTS, negs=NEGATIVE_TYPES):
+    """
+    {(env, neg): (truth, predictions)} of every combination whose files exist, every file read once.
+    task: 'rg4_on_g4' (truth are 0/1 labels) or 'g4_on_rg4' (truth is the rsr of the rG4-seq positions)
+    """
+    pairs, rsr = {}, None
+    for env in envs:
+        for neg in negs:
+            origin_path, preds_path = (rg4_on_g4_paths if task == 'rg4_on_g4' else g4_on_rg4_paths)(data_path, env, neg)
+            if not (os.path.exists(origin_path) and os.path.exists(preds_path)):
+                print(f"Skipping {task} {env}_{neg}: {origin_path} or {preds_path} not found")
+                continue
+            if task == 'rg4_on_g4':
+                pairs[(env, neg)] = read_rg4_on_g4(origin_path, preds_path)
+            else:
+                pairs[(env, neg)] = read_g4_on_rg4(origin_path, preds_path, rsr)
+                rsr = pairs[(env, neg)][0]
+    return pairs
+
+
+def _tie_groups(s):
+    """
+    Ascending sort order of the scores s and the start of every group of tied scores in it.
+    """
+    order = np.argsort(s, kind='stable')
+    s_sorted = s[order]
+    starts = np.flatnonzero(np.r_[True, s_sorted[1:] != s_sorted[:-1]])
+    return order, starts
+
+
+def _group_sums(values, order, starts):
+    # (resamples, n) per element values -> (resamples, groups) sums per group of tied scores, ascending
+    return np.add.reduceat(values[:, order], starts, axis=1)
+
+
+def _weights(w, n):
+    return np.ones((1, n)) if w is None else np.atleast_2d(w).astype(np.float64)
+
+
+def auroc(y, p, w=None):
+    """
+    Area under the ROC curve of 0/1 labels y and scores p, one value per row of the resample weights w
+    (number of times every sample was drawn, None = once each). Mann-Whitney U statistic with ties counted
+    half, equal to sklearn roc_auc_score.
+    """
+    w = _weights(w, len(y))
+    order, starts = _tie_groups(p)
+    pos = _group_sums(w * y, order, starts)
+    neg = _group_sums(w * (1 - y), order, starts)
+    neg_below = np.cumsum(neg, axis=1) - neg
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (pos * (neg_below + neg / 2)).sum(axis=1) / (pos.sum(axis=1) * neg.sum(axis=1))
+
+
+def auprc(y, p, w=None):
+    """
+    Area under the precision recall curve as average precision (equal to sklearn average_precision_score):
+    the precision at every distinct score threshold, weighted by the recall gained there.
+    """
+    w = _weights(w, len(y))
+    order, starts = _tie_groups(p)
+    # thresholds from the highest score down
+    pos = _group_sums(w * y, order, starts)[:, ::-1]
+    total = _group_sums(w, order, starts)[:, ::-1]
+    tp, seen = np.cumsum(pos, axis=1), np.cumsum(total, axis=1)
+    precision = np.divide(tp, seen, out=np.zeros_like(tp), where=seen > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (pos * precision).sum(axis=1) / pos.sum(axis=1)
+
+
+def pearson(x, y, w=None):
+    w = _weights(w, x.shape[-1])
+    total = w.sum(axis=1, keepdims=True)
+    x = x - (w * x).sum(axis=1, keepdims=True) / total
+    y = y - (w * y).sum(axis=1, keepdims=True) / total
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (w * x * y).sum(axis=1) / np.sqrt((w * x * x).sum(axis=1) * (w * y * y).sum(axis=1))
+
+
+def weighted_ranks(s, w=None):
+    """
+    Average ranks (as scipy rankdata) of the scores s in every resample, a sample drawn k times holding k
+    consecutive ranks.
+    """
+    w = _weights(w, len(s))
+    order, starts = _tie_groups(s)
+    counts = _group_sums(w, order, starts)
+    group_rank = np.cumsum(counts, axis=1) - counts + (counts + 1) / 2
+    ranks = np.empty(w.shape)
+    ranks[:, order] = group_rank[:, np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(s)]))]
+    return ranks
+
+
+def spearman(x, y, w=None):
+    return pearson(weighted_ranks(x, w), weighted_ranks(y, w), w)
+
+
+def pair_metrics(truth, preds, binary, w=None):
+    # {metric: (resamples,) values}, the ROC/PR metrics only for 0/1 truth
+    res = {}
+    if binary:
+        res['auroc'] = auroc(truth, preds, w)
+        res['auprc'] = auprc(truth, preds, w)
+    res['pearson'] = pearson(truth, preds, w)
+    res['spearman'] = spearman(truth, preds, w)
+    return res
+
+
+def bootstrap_ci(truth, preds, binary, n_boot, seed=0, alpha=0.05):
+    """
+    Percentile bootstrap (1 - alpha) confidence intervals {metric: (low, high)}. Resamples are drawn as
+    multinomial sample weights, so the scores are sorted once and every resample is scored in linear time,
+    a block of them at once.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(truth)
+    block = max(1, min(BOOTSTRAP_BLOCK, (1 << 22) // n))
+    values = {}
+    for start in range(0, n_boot, block):
+        b = min(block, n_boot - start)
+        draws = rng.integers(0, n, size=(b, n)) + n * np.arange(b)[:, None]
+        w = np.bincount(draws.ravel(), minlength=b * n).reshape(b, n)
+        for name, v in pair_metrics(truth, preds, binary, w).items():
+            values.setdefault(name, []).append(v)
+    return {name: tuple(np.nanquantile(np.concatenate(v), [alpha / 2, 1 - alpha / 2])) for name, v in values.items()}
+
+
+def evaluate_pair(task, env, neg, truth, preds, n_boot=0, seed=0):
+    """
+    One summary table row: sizes, metrics with their p-values (correlations) and bootstrap intervals.
+    """
+    binary = task == 'rg4_on_g4'
+    row = {'task': task, 'env': env, 'neg': neg, 'n': len(truth)}
+    if binary:
+        row['n_pos'] = int(truth.sum())
+    for name, v in pair_metrics(truth, preds, binary).items():
+        row[name] = float(v[0])
+    row['pearson_p'] = pearsonr(truth, preds)[1]
+    row['spearman_p'] = spearmanr(truth, preds)[1]
+    if n_boot:
+        for name, (low, high) in bootstrap_ci(truth, preds, binary, n_boot, seed).items():
+            row[f'{name}_low'], row[f'{name}_high'] = low, high
+    return row
+
+
+def summary_table(pairs_by_task, n_boot=0, workers=1, seed=0):
+    """
+    pairs_by_task: {task: {(env, neg): (truth, preds)}}, as load_pairs returns
+    With workers > 1 the pairs (and their bootstraps) are evaluated in a process pool.
+    """
+    jobs = [(task, env, neg, truth, preds, n_boot, seed)
+            for task, pairs in pairs_by_task.items() for (env, neg), (truth, preds) in pairs.items()]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(evaluate_pair, *zip(*jobs)))
+    else:
+        rows = [evaluate_pair(*job) for job in jobs]
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-rg4", dest="rg4_path", help="path to g4 data and rg4 predicts")
+    parser.add_argument("-g4", dest="g4_path", help="path to rg4 data and g4 predicts")
+    parser.add_argument("-o", "--out", default="metrics_summary.csv", help="Summary table path (default metrics_summary.csv)")
+    parser.add_argument("-b", "--bootstrap", default=0, type=int,
+                        help="Number of bootstrap resamples for 95%% confidence intervals (default 0 = none)")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="Number of processes (default 1)")
+    parser.add_argument("--seed", default=0, type=int, help="Bootstrap seed (default 0)")
+    args = parser.parse_args()
+
+    pairs_by_task = {}
+    if args.rg4_path:
+        pairs_by_task['rg4_on_g4'] = load_pairs(args.rg4_path, 'rg4_on_g4')
+    if args.g4_path:
+        pairs_by_task['g4_on_rg4'] = load_pairs(args.g4_path, 'g4_on_rg4')
+    table = summary_table(pairs_by_task, args.bootstrap, args.workers, args.seed)
+    table.to_csv(args.out, index=False)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(table)
+    print(f"Summary written to {args.out}")
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+
+from tensorflow.keras.layers import Average, Input
+from tensorflow.keras.models import Model, load_model
+
+'''
+Process wide cache of loaded Keras models, so every .h5 file is deserialized once per
+process and shared by all runs that use it.
+'''
+
+_models = {}
+_lock = threading.Lock()
+
+
+def _key(path, kwargs):
+    path = os.path.abspath(path)
+    return path, os.path.getmtime(path), tuple(sorted(kwargs.items()))
+
+
+def load_cached_model(path, **kwargs):
+    """
+    load_model(path, **kwargs), cached on (absolute path, file mtime, kwargs).
+    A model file that changed on disk since it was cached is loaded again.
+    """
+    key = _key(path, kwargs)
+    with _lock:
+        if key not in _models:
+            # drop stale entries of the same file
+            for old in [k for k in _models if k[0] == key[0]]:
+                del _models[old]
+            _models[key] = load_model(path, **kwargs)
+        return _models[key]
+
+
+def load_ensemble(model_dir, size):
+    """
+    Load the rG4detector ensemble members model_0.h5 ... model_{size-1}.h5 from model_dir.
+    """
+    return [load_cached_model(model_dir + f"/model_{i}.h5", compile=False) for i in range(size)]
+
+
+def weights_hash(models):
+    """
+    Hex digest of the weights (values and shapes) of a model or a list of models, in order.
+    """
+    h = hashlib.sha1()
+    for m in models if isinstance(models, (list, tuple)) else [models]:
+        for w in m.get_weights():
+            h.update(str(w.shape).encode())
+            h.update(w.tobytes())
+    return h.hexdigest()
+
+
+def clear_cache():
+    with _lock:
+        _models.clear()
+
+
+def fuse_ensemble(models):
+    """
+    Combine the ensemble members into one Keras model that averages their outputs, so a
+    single predict call runs the whole ensemble.
+    """
+    if len(models) == 1:
+        return models[0]
+    inputs = Input(shape=models[0].inputs[0].shape[1:], name="fused_input")
+    outputs = []
+    for i, m in enumerate(models):
+        # wrap every member so the nested models get unique names in the fused graph
+        member = Model(m.inputs[0], m.outputs[0], name=f"member_{i}")
+        outputs.append(member(inputs))
+    return Model(inputs, Average(name="ensemble_mean")(outputs), name="fused_ensemble")
+
+
+def load_fused_ensemble(model_dir, size):
+    """
+    Load the ensemble (through the cache) and return it fused into a single averaging model.
+    """
+    key = ("fused", os.path.abspath(model_dir), size,
+           tuple(os.path.getmtime(model_dir + f"/model_{i}.h5") for i in range(size)))
+    members = load_ensemble(model_dir, size)
+    with _lock:
+        if key not in _models:
+            for old in [k for k in _models if k[:3] == key[:3]]:
+                del _models[old]
+            _models[key] = fuse_ensemble(members)
+        return _models[key]
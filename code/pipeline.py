@@ -0,0 +1,118 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from time import time
+
+'''
+Producer/consumer inference pipeline: parsing and encoding of batch k+1 run in
+background threads while the model predicts batch k.
+'''
+
+_DONE = object()
+
+
+class StageTimer:
+    """
+    Thread safe accumulator of wall time and item counts per pipeline stage.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, items=0):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.items[stage] += items
+
+    def report(self):
+        lines = []
+        for stage, sec in self.seconds.items():
+            n = self.items[stage]
+            rate = f", {n / sec:,.0f} seqs/s" if n and sec > 0 else ""
+            lines.append(f"{stage:>10}: {sec:.2f}s{rate}")
+        return "\n".join(lines)
+
+
+class DedupStats:
+    """
+    Thread safe count of the sequences seen and of the unique ones that were actually predicted.
+    """
+    def __init__(self):
+        self.total = 0
+        self.unique = 0
+        self._lock = threading.Lock()
+
+    def add(self, total, unique):
+        with self._lock:
+            self.total += total
+            self.unique += unique
+
+    def report(self):
+        ratio = self.total / self.unique if self.unique else 1
+        duplicates = 1 - self.unique / self.total if self.total else 0
+        return f"dedup: {self.unique:,} unique of {self.total:,} sequences ({ratio:.2f}x, {duplicates:.1%} duplicates)"
+
+
+def _timed(func, stage, timer):
+    def wrapper(chunk):
+        t = time()
+        res = func(chunk)
+        timer.add(stage, time() - t, len(chunk))
+        return res
+    return wrapper
+
+
+def run_pipeline(chunks, encode, predict, workers=2, queue_depth=4, timer=None):
+    """
+    Yield (chunk, prediction) for every chunk of chunks, in input order.
+    chunks: iterable of lists (parsing happens lazily while iterating it)
+    encode: chunk -> model input, run on a pool of `workers` threads
+    predict: model input -> predictions, run on the calling thread
+    At most `queue_depth` encoded batches are held in memory at once.
+    """
+    timer = timer if timer is not None else StageTimer()
+    ready = Queue(maxsize=max(1, queue_depth))
+    stop = threading.Event()
+    encode = _timed(encode, "encode", timer)
+
+    def produce(pool):
+        try:
+            it = iter(chunks)
+            while not stop.is_set():
+                t = time()
+                chunk = next(it, _DONE)
+                if chunk is _DONE:
+                    break
+                timer.add("parse", time() - t, len(chunk))
+                ready.put((chunk, pool.submit(encode, chunk)))
+        except BaseException as e:
+            ready.put((e, None))
+            return
+        ready.put((_DONE, None))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        producer = threading.Thread(target=produce, args=(pool,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                t = time()
+                chunk, future = ready.get()
+                if chunk is _DONE:
+                    break
+                if future is None:
+                    raise chunk
+                x = future.result()
+                timer.add("wait", time() - t)
+                t = time()
+                pred = predict(x)
+                timer.add("predict", time() - t, len(chunk))
+                yield chunk, pred
+        finally:
+            # unblock the producer if the consumer stopped early
+            stop.set()
+            while producer.is_alive():
+                while not ready.empty():
+                    ready.get_nowait()
+                producer.join(0.05)
@@ -1,86 +1,139 @@
 from sklearn.metrics import auc, roc_curve
 from scipy.stats import gaussian_kde, pearsonr
+from scipy.signal import fftconvolve
+from scipy.ndimage import map_coordinates
 import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
 import argparse
+from metrics import NEGATIVE_TYPES, g4_on_rg4_paths, read_g4_on_rg4, read_rg4_on_g4, rg4_on_g4_paths
+from rendering import finish_figure, render_all, set_headless
 
-NEGATIVE_TYPES = ['dishuffle', 'pq', 'random']
+DENSITY_METHODS = ['auto', 'kde', 'fft', 'hist']
+KDE_MAX_POINTS = 20000
+RASTERIZE_MIN_POINTS = 5000
 
 '''
 Figures and Pearson correlation of G4detector (DNA) trained model on rG4 (RNA) test set
 '''
 
-def calc_g4detector_on_rg4detector(origin_ds, preds_ds, env, neg):
-    origin = pd.read_csv(origin_ds, header=None, names=["transcript", "position", "rsr", "total_reads", "splice"],
-                         sep=',')
-    preds_g4detector = pd.read_csv(preds_ds, header=None, names=["predicted"], sep=',')
-    origin_score = np.array(origin['rsr'][1:].astype(float))
-    g4detector_prob = np.array(preds_g4detector['predicted'][1:].astype(float))
+def calc_g4detector_on_rg4detector(origin_ds, preds_ds, env, neg, origin_score=None):
+    # origin_score: rsr column of origin_ds if it was already loaded
+    origin_score, g4detector_prob = read_g4_on_rg4(origin_ds, preds_ds, origin_score)
     pearson_cor = pearsonr(origin_score, g4detector_prob)
     print(f'{env}_{neg}: pearson: {pearson_cor[0]}, p-value: {pearson_cor[1]}')
     return origin_score, g4detector_prob
 
 
-def plt_scatter_density(data, origin_score, data_path):
-    for type, g4detector_prob in data.items():
-        env, neg = type.split('_')
-        label = f'{env} {neg}'
-        plt.scatter(origin_score, g4detector_prob, label=label, s=10, alpha=0.4)
-        xy = np.vstack([origin_score, g4detector_prob])
-        z = gaussian_kde(xy)(xy)
-        fig, ax = plt.subplots()
-        density = ax.scatter(origin_score, g4detector_prob, c=z, s=10, alpha=0.9)
-        fig.colorbar(density, label='Density')
-        plt.title(label)
-        plt.xlabel("Observed RSR ratio")
-        plt.ylabel("Predicted G4detector probability")
-        pearson_cor = pearsonr(origin_score, g4detector_prob)
-        plt.legend([str(pearson_cor[0])[:5]], loc='best', frameon=False, markerscale=0)
-        plt.savefig(data_path + f'rsr-g4prob-K-{neg}.jpg')
-        plt.show()
+def fft_kde(x, y, bins=256):
+    """
+    Approximation of gaussian_kde(xy)(xy) in O(n + bins^2 log bins): the points are linearly binned on a
+    bins x bins grid, convolved by FFT with the same Gaussian kernel (Scott's rule bandwidth, full data
+    covariance) and the density is read back at every point by bilinear interpolation.
+    """
+    n = len(x)
+    cov = np.cov(np.vstack([x, y])) * n ** (-1 / 3)
+    lo = np.array([x.min(), y.min()])
+    step = (np.array([x.max(), y.max()]) - lo) / (bins - 1)
+    if not (step > 0).all():
+        return gaussian_kde(np.vstack([x, y]))(np.vstack([x, y]))
+    # fractional grid coordinates, every point spread on its 4 surrounding grid nodes
+    fx, fy = (x - lo[0]) / step[0], (y - lo[1]) / step[1]
+    ix, iy = np.minimum(fx.astype(int), bins - 2), np.minimum(fy.astype(int), bins - 2)
+    tx, ty = fx - ix, fy - iy
+    grid = np.zeros(bins * bins)
+    for dx, dy, weight in ((0, 0, (1 - tx) * (1 - ty)), (1, 0, tx * (1 - ty)), (0, 1, (1 - tx) * ty), (1, 1, tx * ty)):
+        grid += np.bincount((ix + dx) * bins + iy + dy, weights=weight, minlength=bins * bins)
+    # Gaussian kernel on the grid offsets, up to 4 standard deviations
+    half = np.minimum(np.ceil(4 * np.sqrt(np.diag(cov)) / step).astype(int), bins)
+    ox, oy = np.meshgrid(np.arange(-half[0], half[0] + 1) * step[0], np.arange(-half[1], half[1] + 1) * step[1],
+                         indexing='ij')
+    offsets = np.stack([ox, oy], axis=-1)
+    kernel = np.exp(-0.5 * np.einsum('...i,ij,...j->...', offsets, np.linalg.inv(cov), offsets))
+    kernel /= 2 * np.pi * np.sqrt(np.linalg.det(cov)) * n
+    density = fftconvolve(grid.reshape(bins, bins), kernel, mode='same')
+    return map_coordinates(density, [fx, fy], order=1)
+
+
+def hist_density(x, y, bins=256):
+    # density of the 2D histogram bin of every point
+    hist, x_edges, y_edges = np.histogram2d(x, y, bins=bins, density=True)
+    ix = np.clip(np.searchsorted(x_edges, x, side='right') - 1, 0, bins - 1)
+    iy = np.clip(np.searchsorted(y_edges, y, side='right') - 1, 0, bins - 1)
+    return hist[ix, iy]
+
+
+def point_density(x, y, method='auto', bins=256):
+    """
+    Density at every point, for colouring the scatter plot.
+    kde: exact gaussian_kde (O(n^2)), fft: fft_kde, hist: 2D histogram, auto: kde up to KDE_MAX_POINTS
+    points and fft above.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if method == 'auto':
+        method = 'kde' if len(x) <= KDE_MAX_POINTS else 'fft'
+    if method == 'kde':
+        xy = np.vstack([x, y])
+        return gaussian_kde(xy)(xy)
+    if method == 'fft':
+        return fft_kde(x, y, bins)
+    assert method == 'hist', f"Unknown density method {method}, expected one of {DENSITY_METHODS}"
+    return hist_density(x, y, bins)
+
+
+def plt_scatter_density_panel(type, g4detector_prob, origin_score, data_path, density='auto', bins=256):
+    env, neg = type.split('_')
+    label = f'{env} {neg}'
+    z = point_density(origin_score, g4detector_prob, density, bins)
+    fig, ax = plt.subplots()
+    # large point layers are drawn as one image
+    density_layer = ax.scatter(origin_score, g4detector_prob, c=z, s=10, alpha=0.9,
+                               rasterized=len(z) > RASTERIZE_MIN_POINTS)
+    fig.colorbar(density_layer, label='Density')
+    ax.set_title(label)
+    ax.set_xlabel("Observed RSR ratio")
+    ax.set_ylabel("Predicted G4detector probability")
+    pearson_cor = pearsonr(origin_score, g4detector_prob)
+    ax.legend([str(pearson_cor[0])[:5]], loc='best', frameon=False, markerscale=0)
+    finish_figure(fig, data_path + f'rsr-g4prob-K-{neg}.jpg')
+
+
+def plt_scatter_density(data, origin_score, data_path, density='auto', bins=256, workers=1):
+    # one independent figure per negative type
+    jobs = [(type, g4detector_prob, origin_score, data_path, density, bins) for type, g4detector_prob in data.items()]
+    render_all(plt_scatter_density_panel, jobs, workers)
 
 
 def get_g4_scores(env, data_path):
-    scores, origin_score = {}, []
+    # the rG4 data is read once and shared by all negative types
+    scores, origin_score = {}, None
     for neg in NEGATIVE_TYPES:
-        rg4_data = data_path + 'test_tr_data.csv'
-        g4_data = data_path + f'out_g4detector_on_rg4_data/G4detector_prediction_{env}_{neg}.csv'
-        origin, pred = calc_g4detector_on_rg4detector(rg4_data, g4_data, env, neg)
-        if len(origin_score) == 0:
-            origin_score = origin
-            scores.update({f'{env}_{neg}': pred})
-        else:
-            scores.update({f'{env}_{neg}': pred})
+        rg4_data, g4_data = g4_on_rg4_paths(data_path, env, neg)
+        origin_score, pred = calc_g4detector_on_rg4detector(rg4_data, g4_data, env, neg, origin_score)
+        scores.update({f'{env}_{neg}': pred})
     return scores, origin_score
 
 
-def run_plot_g4detector_on_rg4detector(data_path):
+def run_plot_g4detector_on_rg4detector(data_path, density='auto', bins=256, workers=1):
     scores_k, origin_score = get_g4_scores('K', data_path)
-    plt_scatter_density(scores_k, origin_score, data_path)
+    plt_scatter_density(scores_k, origin_score, data_path, density, bins, workers)
 
 '''
 Figures and Pearson correlation of rG4detector (RNA) trained model on G4 (DNA) test set
 '''
-def run_plot_rg4detector_on_g4detector(data_path):
+def run_plot_rg4detector_on_g4detector(data_path, workers=1):
     scores_k = get_rg4_scores('K', data_path)
     scores_pds = get_rg4_scores('KPDS', data_path)
-    plt_auroc(scores_k, 'K', data_path)
-    plt_auroc(scores_pds, 'KPDS', data_path)
+    render_all(plt_auroc, [(scores_k, 'K', data_path), (scores_pds, 'KPDS', data_path)], workers)
 
 def get_rg4_scores(env, data_path):
     scores = {}
     for neg in NEGATIVE_TYPES:
-        origin_ds = data_path + f'data_out_g4detector_label/{env}/{neg}/test.csv'
-        pred_ds = data_path + f'out_rg4detector_on_g4_data/rG4detector_prediction_{env}_{neg}.csv'
+        origin_ds, pred_ds = rg4_on_g4_paths(data_path, env, neg)
         scores.update({f'{env}_{neg}': calc_rg4detector_on_g4detector(origin_ds, pred_ds, env, neg)})
     return scores
 
 def calc_rg4detector_on_g4detector(origin_ds, preds_ds, env, neg):
-    origin = pd.read_csv(origin_ds, header=None, names=["seq", "label"], sep=',')
-    preds = pd.read_csv(preds_ds, header=None, names=["description", "rG4detector prediction"], sep=',')
-    preds_score = preds["rG4detector prediction"][1:].astype(float)
-    origin_label = origin["label"][1:].astype(float)
+    origin_label, preds_score = read_rg4_on_g4(origin_ds, preds_ds)
     pearson_cor = pearsonr(origin_label, preds_score)
     print(f'{env}_{neg}: pearson: {pearson_cor[0]}, p-value: {pearson_cor[1]}')
     fp, tp, threshold = roc_curve(origin_label, preds_score)
@@ -88,24 +141,33 @@ def calc_rg4detector_on_g4detector(origin_ds, preds_ds, env, neg):
     return fp, tp, au
 
 def plt_auroc(data, environment, path):
+    # a figure of its own, the curves of another environment are never drawn into it
+    fig, ax = plt.subplots()
+    ax.plot([0, 1], [0, 1], 'k--')
     for type, values in data.items():
         env, neg = type.split('_')
         fp, tp, au = values
-        plt.figure(1)
-        plt.plot([0, 1], [0, 1], 'k--')
         l = f'{env} {neg}'
-        plt.plot(fp, tp, label= l + '(area = {:.3f})'.format(au))
-        plt.xlabel('False positive rate')
-        plt.ylabel('True positive rate')
-    plt.legend(loc='best')
-    plt.savefig(path+f'{environment}_base_auroc.jpg')
-    plt.show()
+        ax.plot(fp, tp, label= l + '(area = {:.3f})'.format(au))
+    ax.set_xlabel('False positive rate')
+    ax.set_ylabel('True positive rate')
+    ax.legend(loc='best')
+    finish_figure(fig, path+f'{environment}_base_auroc.jpg')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-rg4", dest="rg4_path", help="path to g4 data and rg4 predicts")
     parser.add_argument("-g4", dest="g4_path", help="path to rg4 data and g4 predicts")
+    parser.add_argument("--density", default="auto", choices=DENSITY_METHODS,
+                        help=f"Scatter plot density: exact kde (O(n^2)), fft binned kde or 2D histogram "
+                             f"(default auto = kde up to {KDE_MAX_POINTS} points, fft above)")
+    parser.add_argument("--bins", default=256, type=int, help="Grid size of the fft and hist densities (default 256)")
+    parser.add_argument("--headless", action="store_true",
+                        help="Only save the figures (Agg backend), without opening windows")
+    parser.add_argument("-w", "--workers", default=1, type=int,
+                        help="Number of processes rendering the figures in headless mode (default 1)")
     args = parser.parse_args()
 
-    run_plot_rg4detector_on_g4detector(args.rg4_path)
-    run_plot_g4detector_on_rg4detector(args.g4_path)
\ No newline at end of file
+    set_headless(args.headless)
+    run_plot_rg4detector_on_g4detector(args.rg4_path, args.workers)
+    run_plot_g4detector_on_rg4detector(args.g4_path, args.density, args.bins, args.workers)
\ No newline at end of file
@@ -1,91 +1,190 @@
 import pandas as pd
-from tensorflow.keras.models import load_model
 from utils import get_input_size, get_score_per_position, make_all_seqs_prediction
-from Bio import SeqIO
-import csv
 import argparse
 import matplotlib.pyplot as plt
 from PARAMETERS import *
 from time import time
+from fasta_io import chunked, iter_fasta, read_fasta
+from pipeline import run_pipeline, StageTimer, DedupStats
+from model_registry import load_ensemble, load_fused_ensemble, weights_hash
+from seq_store import SeqStore, is_store
+from checkpoint import Checkpoint
+from prediction_cache import PredictionCache
+from rendering import finish_figure, render_all, set_headless
+from detection_io import DETECTION_FILES, DETECTION_FORMATS, Detection, write_detection
+import numpy as np
+import json
+import os
 """"
 @author: Maor Turner 
 """
 
 def bar_plot(data, desc, dst):
     x = [n for n in range(len(data))]
-    plt.figure(figsize=(6, 4))
-    plt.bar(x, data, width=1)
-    plt.xlabel("Position")
-    plt.ylabel("Prediction")
-    plt.title(desc)
-    plt.savefig(dst + f"/{desc}_detection")
-    plt.show()
+    fig, ax = plt.subplots(figsize=(6, 4))
+    ax.bar(x, data, width=1)
+    ax.set_xlabel("Position")
+    ax.set_ylabel("Prediction")
+    ax.set_title(desc)
+    finish_figure(fig, dst + f"/{desc}_detection")
 
 
-def predict_fasta(model, src, dst, env, neg):
-    # get sequences
-    fasta_file = SeqIO.parse(open(src), 'fasta')
-    print(fasta_file)
-    seqs = [str(seq.seq).upper() for seq in fasta_file]
-    print(f"Number of sequences = {len(seqs)}")
+def read_sequences(src):
+    # fasta file or a sequence store built by seq_store.py, descriptions and sequences in a single pass
+    if is_store(src):
+        store = SeqStore(src)
+        return store.headers, store.strings()
+    return read_fasta(src, upper=True)
+
+
+def predict_seqs(model, seqs, cache=None, dedup=None):
+    # with dedup every distinct sequence is predicted once and its prediction copied back to the duplicates,
+    # with a prediction cache only the sequences that were not scored before reach the ensemble
+    if dedup is not None:
+        inverse, uniques = pd.factorize(pd.Series(seqs, dtype=object))
+        dedup.add(len(seqs), len(uniques))
+        return np.asarray(predict_seqs(model, list(uniques), cache))[inverse]
+    if cache is None:
+        return make_all_seqs_prediction(model, seqs=seqs, pad="Z")
+    return cache.predict(seqs, lambda idx: make_all_seqs_prediction(model, seqs=[seqs[i] for i in idx], pad="Z"))
+
+
+def predict_fasta(model, src, dst, env, neg, chunk_size=0, workers=2, queue_depth=4, checkpoint=None, cache=None,
+                  dedup=None):
+    if chunk_size > 0:
+        seqs_description, all_preds = pipelined_prediction(model, src, chunk_size, workers, queue_depth, checkpoint,
+                                                           cache, dedup)
+    else:
+        # get sequences
+        seqs_description, seqs = read_sequences(src)
+        print(f"Number of sequences = {len(seqs)}")
 
-    all_preds = make_all_seqs_prediction(model, seqs=seqs, pad="Z")
+        all_preds = predict_seqs(model, seqs, cache, dedup)
+    if dedup is not None:
+        print(dedup.report())
 
     # save to file
-    seqs_description = [s.description for s in SeqIO.parse(open(src), 'fasta')]
     preds_df = pd.DataFrame(data=list(zip(seqs_description, all_preds)), columns=["description", "rG4detector prediction"])
     preds_df.to_csv(dst + f"/rG4detector_prediction_{env}_{neg}.csv", index=False)
 
 
-def detect_fasta(model, src, dst, plot):
+def pipelined_prediction(model, src, chunk_size, workers, queue_depth, checkpoint=None, cache=None, dedup=None):
+    # fasta parsing of the next chunks runs in the background while the ensemble predicts the current one
+    # with a checkpoint, every predicted chunk is saved as a shard and finished chunks are skipped on restart
+    timer = StageTimer()
+    records = SeqStore(src).record_chunks(chunk_size) if is_store(src) else chunked(iter_fasta(src), chunk_size)
+    if checkpoint is not None:
+        records = checkpoint.pending(records)
+    seqs_description, all_preds = [], []
+    for chunk, preds in run_pipeline(records,
+                                     encode=lambda c: [seq.upper() for _, seq in c],
+                                     predict=lambda seqs: predict_seqs(model, seqs, cache, dedup),
+                                     workers=workers, queue_depth=queue_depth, timer=timer):
+        if checkpoint is not None:
+            checkpoint.save(description=np.array([desc for desc, _ in chunk]), prediction=np.asarray(preds))
+        else:
+            seqs_description.extend(desc for desc, _ in chunk)
+            all_preds.extend(preds)
+    if checkpoint is not None:
+        for shard in checkpoint.shards():
+            seqs_description.extend(shard["description"].tolist())
+            all_preds.extend(shard["prediction"])
+    print(f"Number of sequences = {len(seqs_description)}")
+    print(timer.report())
+    return seqs_description, all_preds
+
+
+def detect_fasta(model, src, dst, plot, plot_workers=1, fmt='csv'):
     # get sequences
-    fasta_file = SeqIO.parse(open(src), 'fasta')
-    seqs = [str(seq.seq).upper() for seq in fasta_file]
+    seqs_description, seqs = read_sequences(src)
     print(f"Number of sequences = {len(seqs)}")
 
     # make predictions
     preds = make_all_seqs_prediction(model, seqs=seqs, max_pred=False, pad="Z", verbose=1)
-    seqs_preds = []
-    for p, io_seq in zip(preds, SeqIO.parse(open(src), 'fasta')):
-        positions_score = get_score_per_position(p, get_input_size(model), DETECTION_SIGMA)
-        seqs_preds.append(positions_score)
-        if plot:
-            bar_plot(positions_score, dst=dst, desc=io_seq.description)
-
-    with open(dst + '/detection.csv', 'w') as f:
-        write = csv.writer(f)
-        for pred, io_seq in zip(seqs_preds, SeqIO.parse(open(src), 'fasta')):
-            write.writerow([io_seq.description] + [n for n in str(io_seq.seq).upper()])
-            write.writerow([""] + list(pred))
+    input_size = get_input_size(model)
+    detection = Detection.from_scores(seqs_description,
+                                      [get_score_per_position(p, input_size, DETECTION_SIGMA) for p in preds])
+    del preds
+    if plot:
+        # one independent figure per sequence
+        render_all(bar_plot, ((scores, desc, dst) for desc, scores in detection.items()), plot_workers)
+
+    write_detection(os.path.join(dst, DETECTION_FILES[fmt]), detection, fmt, seqs)
     return
 
 
-def run_main(env, neg):
+def user_input():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--fasta", dest="fasta_path", help="Fasta file for path")
+    parser.add_argument("-f", "--fasta", dest="fasta_path",
+                        help="Fasta file for path (or a sequence store built by seq_store.py)")
     parser.add_argument("-m", "--model", dest="model_path" ,help="rG4detector model directory (default = model/)")
     parser.add_argument("-d", "--detect", action="store_true" ,help="Operate in detection mode (default is evaluation mode)")
     parser.add_argument("-p", "--plot", action="store_true", help="Plot detection results (for detection only)")
+    parser.add_argument("--detection-format", dest="detection_format", default="csv", choices=DETECTION_FORMATS,
+                        help="Detection output: csv (two rows per sequence, detection.csv), npz (ragged scores "
+                             "with an offsets index, detection.npz) or tsv (long format, detection.tsv.gz)")
+    parser.add_argument("--headless", action="store_true",
+                        help="Only save the detection plots (Agg backend), without opening windows")
+    parser.add_argument("--plot-workers", dest="plot_workers", default=1, type=int,
+                        help="Number of processes rendering the detection plots in headless mode (default 1)")
     parser.add_argument("-o", "--output", help="Output directory")
     parser.add_argument("-s", "--size", dest="ensemble_size", default=11, type=int, help="ensemble size (default 11)")
-    args = parser.parse_args()
+    parser.add_argument("--fuse", action="store_true",
+                        help="Fuse the ensemble into a single averaging model (one predict call per batch)")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", default=0, type=int,
+                        help="Predict in pipelined chunks of this many sequences (default 0 = whole file at once)")
+    parser.add_argument("--workers", default=2, type=int, help="Number of background worker threads (default 2)")
+    parser.add_argument("--queue-depth", dest="queue_depth", default=4, type=int,
+                        help="Max number of prepared chunks waiting for prediction (default 4)")
+    parser.add_argument("--checkpoint", help="Checkpoint directory for chunked prediction: every predicted chunk is "
+                                             "saved there and an interrupted run resumes from it")
+    parser.add_argument("--cache", help="Prediction cache file (SQLite): sequences scored before by the same ensemble "
+                                        "are not predicted again")
+    parser.add_argument("--cache-size", dest="cache_size", default=1024, type=float,
+                        help="Prediction cache size limit in MB, least recently used predictions are evicted (default 1024)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Predict every distinct sequence once and copy its prediction to the duplicates")
+    return parser.parse_args()
+
 
-    rG4detector_model = []
-    for i in range(args['ensemble_size']):
-        rG4detector_model.append(load_model(args['model_path'] + f"/model_{i}.h5", compile=False))
+def run_main(args, env, neg):
+    start = time()
+    # ensemble members are loaded once per process and shared by all env/neg runs
+    if args.fuse:
+        rG4detector_model = [load_fused_ensemble(args.model_path, args.ensemble_size)]
+    else:
+        rG4detector_model = load_ensemble(args.model_path, args.ensemble_size)
     if not args.detect:
-        predict_fasta(model=rG4detector_model, src=args.fasta_path, dst=args.output, env=env, neg=neg)
+        checkpoint = None
+        if args.checkpoint:
+            assert args.chunk_size > 0, "--checkpoint needs chunked prediction (-c <chunk size>)"
+            tag = json.dumps({"model": os.path.abspath(args.model_path), "size": args.ensemble_size, "fuse": args.fuse})
+            checkpoint = Checkpoint(os.path.join(args.checkpoint, f"{env}_{neg}"), args.fasta_path, args.chunk_size, tag)
+        cache = None
+        if args.cache:
+            # fused and separate ensembles differ in float rounding, they are cached separately
+            model_key = f"rG4detector {weights_hash(rG4detector_model)} fuse={args.fuse} pad=Z"
+            cache = PredictionCache(args.cache, model_key, args.cache_size)
+        predict_fasta(model=rG4detector_model, src=args.fasta_path, dst=args.output, env=env, neg=neg,
+                      chunk_size=args.chunk_size, workers=args.workers, queue_depth=args.queue_depth,
+                      checkpoint=checkpoint, cache=cache, dedup=DedupStats() if args.dedup else None)
+        if cache is not None:
+            print(cache.report())
+            cache.close()
     else:
-        detect_fasta(model=rG4detector_model, src=args.fasta_path, dst=args.output, plot=args.plot)
-    end = time()
-    total = end - start
-    print('time to run: ', total)
+        detect_fasta(model=rG4detector_model, src=args.fasta_path, dst=args.output, plot=args.plot,
+                     plot_workers=args.plot_workers, fmt=args.detection_format)
+    print(f'time to run {env}_{neg}: ', time() - start)
+
 
 if __name__ == "__main__":
     start = time()
     # parse command line args
+    args = user_input()
+    set_headless(args.headless)
     environment = ['KPDS', 'K']
     negative_type = ['dishuffle', 'pq', 'random']
     for env in environment:
         for neg in negative_type:
-            run_main(env, neg)
+            run_main(args, env, neg)
+    print('total time to run: ', time() - start)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+'''
+On-disk, content addressed cache of model predictions (SQLite), shared by the inference scripts.
+Rows are keyed by (model, sequence digest): the model key is a hash of the weights (see
+model_registry.weights_hash) and of anything else the prediction depends on, the sequence is whatever
+uniquely determines the model input (the encoded window, or the sequence itself). Only cache misses are
+predicted. The least recently used rows are evicted once the cache grows over its size limit.
+'''
+
+SELECT_BATCH = 500
+
+
+def _digest(key):
+    if isinstance(key, str):
+        key = key.encode()
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
+class PredictionCache:
+    """
+    path: SQLite file, created if needed
+    model_key: string identifying the model (and prediction options) the cached values belong to
+    max_mb: size limit of the cached values in MB (None = unlimited)
+    """
+    def __init__(self, path, model_key, max_mb=None):
+        self.path = path
+        self.model_key = model_key
+        self.max_bytes = None if max_mb is None else int(max_mb * (1 << 20))
+        self.hits = self.misses = self.evicted = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dtype TEXT, shape TEXT);
+            CREATE TABLE IF NOT EXISTS preds (model TEXT, key BLOB, value BLOB, size INTEGER, last_used INTEGER,
+                                              PRIMARY KEY (model, key));
+            CREATE INDEX IF NOT EXISTS preds_last_used ON preds (last_used);
+        ''')
+        row = self.db.execute("SELECT dtype, shape FROM models WHERE model = ?", (model_key,)).fetchone()
+        self.dtype, self.shape = (np.dtype(row[0]), tuple(json.loads(row[1]))) if row else (None, None)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM preds").fetchone()[0]
+        self.tick = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM preds").fetchone()[0]
+
+    def _lookup(self, digests):
+        found = {}
+        for start in range(0, len(digests), SELECT_BATCH):
+            batch = digests[start:start + SELECT_BATCH]
+            rows = self.db.execute(f"SELECT key, value FROM preds WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                                   (self.model_key, *batch))
+            found.update(rows)
+        return found
+
+    def predict(self, keys, predict_missing):
+        """
+        Predictions for keys, in order, as one array of shape (len(keys),) + row shape.
+        predict_missing: array of indices into keys -> predictions of those keys (one row per index),
+        called once per call with the cache misses only.
+        """
+        self.tick += 1
+        digests = [_digest(k) for k in keys]
+        found = self._lookup(list(set(digests)))
+        missing = np.array([i for i, d in enumerate(digests) if d not in found], dtype=np.int64)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        new = {}
+        if len(missing):
+            pred = np.asarray(predict_missing(missing))
+            if self.dtype is None:
+                self.dtype, self.shape = pred.dtype, pred.shape[1:]
+                self.db.execute("INSERT OR REPLACE INTO models VALUES (?, ?, ?)",
+                                (self.model_key, self.dtype.str, json.dumps(self.shape)))
+            assert pred.dtype == self.dtype and pred.shape[1:] == self.shape, \
+                f"Predictions do not match the cached {self.dtype}{self.shape} values of {self.model_key}"
+            for i, row in zip(missing, pred):
+                new[digests[i]] = row.tobytes()
+            self.db.executemany("INSERT OR REPLACE INTO preds VALUES (?, ?, ?, ?, ?)",
+                                [(self.model_key, d, v, len(v), self.tick) for d, v in new.items()])
+            self.size += sum(len(v) for v in new.values())
+        if found:
+            self.db.executemany("UPDATE preds SET last_used = ? WHERE model = ? AND key = ?",
+                                [(self.tick, self.model_key, d) for d in found])
+        self._evict()
+        self.db.commit()
+
+        if not len(keys):
+            return np.empty((0,) + (self.shape or ()), dtype=self.dtype or np.float32)
+        found.update(new)
+        out = np.frombuffer(b''.join(found[d] for d in digests), dtype=self.dtype)
+        return out.reshape((len(keys),) + self.shape).copy()
+
+    def _evict(self):
+        if self.max_bytes is None or self.size <= self.max_bytes:
+            return
+        # drop least recently used rows (of any model) down to 90% of the limit
+        target = self.size - int(0.9 * self.max_bytes)
+        freed, rowids = 0, []
+        for rowid, size in self.db.execute("SELECT rowid, size FROM preds ORDER BY last_used"):
+            if freed >= target:
+                break
+            rowids.append((rowid,))
+            freed += size
+        self.db.executemany("DELETE FROM preds WHERE rowid = ?", rowids)
+        self.size -= freed
+        self.evicted += len(rowids)
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (f"prediction cache {self.path}: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), "
+                f"{self.evicted} evicted, {self.size / (1 << 20):.1f} MB")
+
+    def close(self):
+        self.db.close()
+
@@ -0,0 +1,91 @@
+import json
+import os
+
+import numpy as np
+
+'''
+Columnar transcript annotation cache, replacing the pickled chr_dict of transcript objects.
+
+Layout of a cache directory:
+    meta.json                 - source GFF3 (path, size, mtime) and the chromosome/strand tables
+    <chrom>_<plus|minus>/     - one table per chromosome and strand, every column a .npy file
+                                (see extract_most_prominent_transcript.transcript_arrays)
+Tables are memory mapped and loaded lazily, one chromosome strand at a time.
+'''
+
+META_FILE = "meta.json"
+STRAND_NAMES = {"+": "plus", "-": "minus"}
+
+
+def _table_dir(cache_dir, chrom, strand):
+    return os.path.join(cache_dir, f"{chrom}_{STRAND_NAMES[strand]}")
+
+
+def _source_stamp(gff_path):
+    st = os.stat(gff_path)
+    return {"path": os.path.abspath(gff_path), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def write_annotation_cache(tables, cache_dir, gff_path):
+    """
+    tables: {chrom: {strand: columns}} with columns as returned by transcript_arrays
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    layout = {}
+    for chrom in tables:
+        for strand, columns in tables[chrom].items():
+            table_dir = _table_dir(cache_dir, chrom, strand)
+            os.makedirs(table_dir, exist_ok=True)
+            for name, values in columns.items():
+                np.save(os.path.join(table_dir, f"{name}.npy"), values)
+            layout.setdefault(chrom, []).append(strand)
+    # meta is written last, a cache without it is incomplete
+    with open(os.path.join(cache_dir, META_FILE), "w") as f:
+        json.dump({"source": _source_stamp(gff_path), "tables": layout}, f)
+
+
+def is_stale(cache_dir, gff_path=None):
+    """
+    True if the cache is missing or was built from a GFF3 that changed since (gff_path defaults
+    to the recorded source).
+    """
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return True
+    with open(meta_path) as f:
+        source = json.load(f)["source"]
+    gff_path = gff_path or source["path"]
+    if not os.path.exists(gff_path):
+        # source not available here, trust the cache
+        return False
+    stamp = _source_stamp(gff_path)
+    return stamp["path"] != source["path"] or stamp["size"] != source["size"] or stamp["mtime"] != source["mtime"]
+
+
+class AnnotationCache:
+    """
+    Lazily loaded, memory mapped chromosome/strand tables of a cache directory.
+    cache.table(chrom, strand) returns a {column: array} dictionary.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.source = meta["source"]
+        self.layout = meta["tables"]
+        self._tables = {}
+
+    def chromosomes(self):
+        return list(self.layout)
+
+    def __contains__(self, key):
+        chrom, strand = key
+        return strand in self.layout.get(chrom, [])
+
+    def table(self, chrom, strand):
+        if (chrom, strand) not in self._tables:
+            table_dir = _table_dir(self.cache_dir, chrom, strand)
+            self._tables[(chrom, strand)] = {
+                name[:-len(".npy")]: np.load(os.path.join(table_dir, name), mmap_mode="r")
+                for name in os.listdir(table_dir) if name.endswith(".npy")}
+        return self._tables[(chrom, strand)]
@@ -1,86 +1,136 @@
-from extract_most_prominent_transcript import get_transcript_and_position, transcript
+from extract_most_prominent_transcript import get_transcript_and_position, load_transcripts_locations, \
+    map_positions_shard, TranscriptIndex
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import sys
 import os
+import numpy as np
 import pandas as pd
-import pickle
-from Bio import SeqIO
 import re
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from fasta_io import FastaIndex, write_fasta, write_lines
+
 '''
 @author: Maor Turner
 '''
 
 # Execution:
 # under csv_data directory run:
-# csv2seq.py  <chr_dict_path> <transcripts_fasta_path>
+# csv2seq.py  <transcripts_locations_dir> <transcripts_fasta_path> [--workers N] [--output-dir DIR] [--gzip]
 
 FLANK_SIZE = 47
 SEQ_SIZE = 30
+WINDOW_SIZE = FLANK_SIZE*2 + SEQ_SIZE
+
+
+def transcript_id(name):
+    m = re.search(r'(ENST\d+\.\d*)|', name)
+    assert m, f"Did not find transcript ID in {name}"
+    return m.group(1)
+
+
+def extract_windows(tr_data_df, transcripts_fasta):
+    """
+    Cut the Z-padded window around every position. Only the subrange of every transcript that its
+    windows cover is read from the indexed FASTA, converted to an upper case byte array once and all
+    of its windows are cut with one fancy-indexing operation.
+    """
+    windows = np.empty((len(tr_data_df), WINDOW_SIZE), dtype=np.uint8)
+    offsets = np.arange(WINDOW_SIZE)
+    positions = tr_data_df["position"].to_numpy(dtype=np.int64)
+    for tr_id, rows in tr_data_df.groupby("transcript", sort=False).indices.items():
+        tr_len = transcripts_fasta.length(tr_id)
+        seq_start = positions[rows] - SEQ_SIZE - FLANK_SIZE - 1
+        assert ((seq_start >= -WINDOW_SIZE) & (seq_start <= tr_len)).all(), f"ERROR: window out of {tr_id} range"
+        lo = max(0, int(seq_start.min()))
+        sub_seq = transcripts_fasta.fetch(tr_id, lo, int(seq_start.max()) + WINDOW_SIZE).upper().encode()
+        padded = np.frombuffer(b"Z"*WINDOW_SIZE + sub_seq + b"Z"*WINDOW_SIZE, dtype=np.uint8)
+        windows[rows] = padded[seq_start[:, None] - lo + WINDOW_SIZE + offsets]
+    return [w.decode() for w in windows.view(f"S{WINDOW_SIZE}").ravel()]
 
-# get path from command line
-if len(sys.argv) != 3:
-    print("ERROR:\n"
-          "Execution: csv2seq.py  <chr_dict_path> <transcripts_fasta_path>\n"
-          "Run under csv_data directory")
-    exit(1)
-chr_dict_path = sys.argv[1]
-transcripts_fasta_path = sys.argv[2]
-
-# set output directory
-output_dir = "/out/"
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# load transcripts locations and tsl data
-with open(chr_dict_path, 'rb') as f:
-    chr_dict = pickle.load(f)
-
-# load transcripts in to dictionary and set keys
-original_transcripts_dict = SeqIO.to_dict(SeqIO.parse(transcripts_fasta_path, "fasta"))
-transcripts_dict = {}
-for key in original_transcripts_dict:
-    m = re.search(r'(ENST\d+\.\d*)|', key)
-    assert m, f"Did not find transcript ID in {key}"
-    transcripts_dict[m.group(1)] = original_transcripts_dict[key]
-del original_transcripts_dict
-
-# you can also loop over all 3 data sets of rG4detector
-data_sets = ["test"]
-for data in data_sets:
-    data_df = pd.read_csv(f'{data}_data.csv')
-
-    # get position locations in the most prominent transcript
-    tr_data_df = pd.DataFrame(columns=["transcript", "position", "rsr", "total_reads"])
+
+def map_locations(data_df, tr_locations_path, annotation, tr_index, workers=1):
+    """
+    Get position locations in the most prominent transcript for every chromosome and strand.
+    With workers > 1 the (independent) chromosome/strand shards are mapped in a process pool, every
+    worker memory maps its shard from the annotation cache instead of receiving pickled transcripts.
+    Results are merged in the serial order.
+    """
+    shards = []
     for chrom in data_df["chromosome"].unique():
         for strand in ("+", "-"):
-            print(f"Extracting locations for {chrom}{strand}")
             s_data = data_df[(data_df["chromosome"] == chrom) & (data_df["strand"] == strand)]
-            s_locations_df = get_transcript_and_position(pos_list=s_data["position"].tolist(),
-                                                         tr_list=chr_dict[chrom][strand],
-                                                         rsr_list=s_data["rsr"].tolist(),
-                                                         reads_list=s_data["total_reads"].tolist(),
-                                                         strand=strand)
-            tr_data_df = pd.concat([tr_data_df, s_locations_df], ignore_index=True, axis=0)
-    tr_data_df.to_csv(f"{data}_tr_data.csv", index=False)
-
-    seqs = []
-    f=0
-    for idx, row in tr_data_df.iterrows():
-        seq_start = row["position"] - SEQ_SIZE - FLANK_SIZE - 1
-        seq_end = seq_start + FLANK_SIZE*2 + SEQ_SIZE
-        trans_seq = str(transcripts_dict[row["transcript"]].seq)
-        seq = trans_seq[max(0, seq_start):min(len(trans_seq), seq_end)]
-        seq = "Z"*max(-seq_start, 0) + seq.upper() + "Z"*max(0, seq_end - len(trans_seq))
-        assert len(seq) == FLANK_SIZE*2 + SEQ_SIZE, f"ERROR: seq length == {len(seq)}"
-        seqs.append(seq)
-
-    # write sequences to file
-    with open(output_dir + f"{data}-seq", 'w') as f:
-        for s in seqs:
-            f.write(f"{s}\n")
-    # write also in fasta format
-    with open(output_dir + f"{data}.fa", 'w') as f:
-        for i, s in enumerate(seqs):
-            header = tr_data_df.iloc[i]["transcript"] + "-" + str(tr_data_df.iloc[i]["position"])
-            f.write(f">{header}\n{s}\n")
-print("All done!")
+            shards.append((chrom, strand, s_data["position"].tolist(), s_data["rsr"].tolist(),
+                           s_data["total_reads"].tolist()))
+
+    tr_data_frames = [pd.DataFrame(columns=["transcript", "position", "rsr", "total_reads"])]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # largest shards first for load balancing, collected back in shard order
+            order = sorted(range(len(shards)), key=lambda i: -len(shards[i][2]))
+            futures = {i: pool.submit(map_positions_shard, tr_locations_path, *shards[i]) for i in order}
+            for i, (chrom, strand, *_) in enumerate(shards):
+                print(f"Extracting locations for {chrom}{strand}")
+                tr_data_frames.append(futures[i].result())
+    else:
+        for chrom, strand, pos_list, rsr_list, reads_list in shards:
+            print(f"Extracting locations for {chrom}{strand}")
+            # the index is built once per chromosome and strand and reused by every data set
+            if (chrom, strand) not in tr_index:
+                tr_index[(chrom, strand)] = TranscriptIndex(annotation.table(chrom, strand), strand)
+            s_locations_df = get_transcript_and_position(pos_list=pos_list,
+                                                         tr_list=None,
+                                                         rsr_list=rsr_list,
+                                                         reads_list=reads_list,
+                                                         strand=strand,
+                                                         index=tr_index[(chrom, strand)])
+            tr_data_frames.append(s_locations_df)
+    return pd.concat(tr_data_frames, ignore_index=True, axis=0)
+
+
+def main():
+    # get path from command line
+    parser = argparse.ArgumentParser(description="Run under csv_data directory")
+    parser.add_argument("tr_locations_path", help="transcripts_locations directory")
+    parser.add_argument("transcripts_fasta_path", help="transcripts fasta file")
+    parser.add_argument("-w", "--workers", default=1, type=int,
+                        help="Number of processes mapping chromosome/strand shards in parallel (default 1)")
+    parser.add_argument("-o", "--output-dir", default="out",
+                        help="Output directory for the sequence files (default out/ under the working directory)")
+    parser.add_argument("--gzip", action="store_true", help="gzip compress the sequence files")
+    args = parser.parse_args()
+
+    # set output directory
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    suffix = ".gz" if args.gzip else ""
+
+    # load transcripts locations and tsl data (rebuilt if the source GFF3 changed)
+    annotation = load_transcripts_locations(args.tr_locations_path)
+
+    # index the transcripts fasta (cached as <fasta>.fai), sequences are read on demand by transcript ID
+    transcripts_fasta = FastaIndex(args.transcripts_fasta_path, key=transcript_id)
+
+    # you can also loop over all 3 data sets of rG4detector
+    data_sets = ["test"]
+    tr_index = {}
+    for data in data_sets:
+        data_df = pd.read_csv(f'{data}_data.csv')
+
+        # get position locations in the most prominent transcript
+        tr_data_df = map_locations(data_df, args.tr_locations_path, annotation, tr_index, args.workers)
+        tr_data_df.to_csv(f"{data}_tr_data.csv", index=False)
+
+        seqs = extract_windows(tr_data_df, transcripts_fasta)
+
+        # write sequences to file
+        write_lines(os.path.join(output_dir, f"{data}-seq{suffix}"), seqs)
+        # write also in fasta format
+        headers = tr_data_df["transcript"] + "-" + tr_data_df["position"].astype(str)
+        write_fasta(os.path.join(output_dir, f"{data}.fa{suffix}"), headers, seqs)
+    print("All done!")
+
+
+if __name__ == "__main__":
+    main()
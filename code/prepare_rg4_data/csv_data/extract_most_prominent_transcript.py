@@ -1,10 +1,13 @@
 import re
+from bisect import bisect_left
+from operator import attrgetter, itemgetter
 import gzip
-import pickle
 import os
 from time import time
 import sys
+import numpy as np
 import pandas as pd
+from annotation_cache import AnnotationCache, is_stale, write_annotation_cache
 
 '''
 @author: Maor Turner
@@ -14,6 +17,8 @@ chr_dict = {}
 
 
 class transcript:
+    __slots__ = ("name", "len", "exons_ranges", "start", "end", "gene", "tsl", "strand")
+
     def __init__(self, name, length, start, end, tsl, gene, strand):
         self.name = name
         self.len = length
@@ -26,17 +31,17 @@ class transcript:
 
 
     def add_exon(self, start, end):
-        pos = 0
+        """
+        Keep exons ordered by start, ascending on "+" and descending on "-" strand (exons with equal
+        starts keep their insertion order). GFF files list exons in transcript order, so this is
+        normally an append, otherwise a stable (near linear) timsort restores the order.
+        """
         start, end = int(start), int(end)
-        while pos < len(self.exons_ranges):
-            if self.strand == "+":
-                if start < self.exons_ranges[pos][0]:
-                    break
-            else:
-                if start > self.exons_ranges[pos][0]:
-                    break
-            pos += 1
-        self.exons_ranges.insert(pos, (start, end))
+        in_order = not self.exons_ranges or \
+            (start >= self.exons_ranges[-1][0] if self.strand == "+" else start <= self.exons_ranges[-1][0])
+        self.exons_ranges.append((start, end))
+        if not in_order:
+            self.exons_ranges.sort(key=itemgetter(0), reverse=self.strand != "+")
 
     def __str__(self):
         print_str = f"name = {self.name}\nlength = {self.len}\nstart = {self.start}\nend = {self.end}\n" \
@@ -44,6 +49,24 @@ class transcript:
         return print_str
 
 
+GZ_RE = re.compile(r".+\.gz$")
+
+
+def parse_gff_attributes(infos):
+    """
+    Parse the GFF3 attributes column once into a dictionary.
+    Like the 'key=(.+?);' searches it replaces, only ';' terminated attributes are kept.
+    # >>> parse_gff_attributes("ID=ENST001;gene_id=ENSG001;transcript_support_level=1;tag=basic")
+    {'ID': 'ENST001', 'gene_id': 'ENSG001', 'transcript_support_level': '1'}
+    """
+    attributes = {}
+    for field in infos.split(";")[:-1]:
+        key, sep, value = field.partition("=")
+        if sep and value and key not in attributes:
+            attributes[key] = value
+    return attributes
+
+
 def check_convert_chr_id(chr_id):
     """
     Check and convert chromosome IDs to format:
@@ -85,239 +108,292 @@ def check_convert_chr_id(chr_id):
     return chr_id
 
 
-def gff_get_transcript_lengths(in_gff, tr2exc_dic=None):
+def sort_transcripts():
+    # stable sort: transcripts with equal starts keep their GFF order
+    for chrom in chr_dict:
+        for strand in chr_dict[chrom]:
+            chr_dict[chrom][strand] = sorted(chr_dict[chrom][strand].values(), key=attrgetter("start"))
+
+
+def get_transcripts_locations(in_gff, out_dir):
     """
-    Get transcript lengths (= length of their exons, not unspliced length!)
-    from GFF file.
-    tr2exc_dic:
-    Optionally provide a transcript ID to exon count dictionary for counting
-    transcript exons.
-    # >>> in_gtf = "test_data/map_test_in.gtf"
-    # >>> gtf_get_transcript_lengths(in_gtf)
-    {'ENST001': 2000, 'ENST002': 2000}
+    Parse the GFF3 and write the transcripts annotation cache to <out_dir>/transcripts_locations
     """
+    build_transcripts_cache(in_gff, f"{out_dir}/transcripts_locations")
 
-    t = time()
-    # Transcript ID to exonic length dictionary.
-    tr2len_dic = {}
-    # Open GFF either as .gz or as text file.
-    if re.search(".+\.gz$", in_gff):
-        fp = gzip.open(in_gff, 'rt')
-    else:
-        fp = open(in_gff, "r")
-    for line in fp:
-        # Skip header.
-        if re.search("^#", line):
-            continue
-        cols = line.strip().split("\t")
-        feature = cols[2]
-        feat_s = int(cols[3])
-        feat_e = int(cols[4])
-        infos = cols[8]
-        if not feature == "exon":
-            continue
-        # Extract transcript ID.
-        m = re.search('transcript_id=(.+?);', infos)
-        assert m, "transcript_id entry missing in GTF file \"%s\", line \"%s\"" % (in_gff, line)
-        tr_id = m.group(1)
-        # Sum up length.
-        ex_len = feat_e - feat_s + 1
-        if tr_id not in tr2len_dic:
-            tr2len_dic[tr_id] = ex_len
-        else:
-            tr2len_dic[tr_id] += ex_len
-        if tr2exc_dic is not None:
-            if tr_id not in tr2exc_dic:
-                tr2exc_dic[tr_id] = 1
-            else:
-                tr2exc_dic[tr_id] += 1
-    fp.close()
-    assert tr2len_dic, "No IDs read into dictionary (input file \"%s\" empty or malformatted?)" % (in_gff)
 
-    print(f"gff_get_transcript_lengths execution time = {round(time()-t)}s")
-    return tr2len_dic
+def load_transcripts_locations(cache_dir, in_gff=None):
+    """
+    Open the transcripts annotation cache, (re)building it first if it is missing or older than
+    its source GFF3 (in_gff, or the GFF3 the cache was built from).
+    """
+    if is_stale(cache_dir, in_gff):
+        if in_gff is None:
+            assert os.path.exists(os.path.join(cache_dir, "meta.json")), \
+                f"No transcripts annotation cache in {cache_dir}, a GFF3 path is needed to build it"
+            in_gff = AnnotationCache(cache_dir).source["path"]
+        print(f"Transcripts annotation cache {cache_dir} is stale, rebuilding from {in_gff}")
+        build_transcripts_cache(in_gff, cache_dir)
+    return AnnotationCache(cache_dir)
 
 
-def sort_transcripts():
-    for chrom in chr_dict:
-        for strand in chr_dict[chrom]:
-            chr_list = []
-            for tr in chr_dict[chrom][strand]:
-                pos = 1
-                while pos <= len(chr_list):
-                    if chr_dict[chrom][strand][tr].start >= chr_list[-pos].start:
-                        break
-                    pos += 1
-                chr_list.insert(len(chr_list)-pos+1, chr_dict[chrom][strand][tr])
-            chr_dict[chrom][strand] = chr_list
+def build_transcripts_cache(in_gff, cache_dir):
+    read_gff_transcripts(in_gff)
 
+    print("Sorting transcripts")
+    t = time()
+    sort_transcripts()
+    print(f"Done Sorting - {round((time()-t))}s")
+
+    write_transcripts_cache(in_gff, cache_dir)
 
-def get_transcripts_locations(in_gff, out_dir):
-    id2sc = {}
-    for i in range(5):
-        pos = i + 1
-        pos_str = "%i" % pos
-        id2sc[pos_str] = pos
-    id2sc["NA"] = 6
-
-    # Read in transcript length (exonic regions).
-    print("Read in transcript lengths (exonic lengths) from GTF ... ")
-    tr2exc_dic = {}
-    tr2len_dic = gff_get_transcript_lengths(in_gff, tr2exc_dic=tr2exc_dic)
-    assert tr2len_dic, "no transcript lengths read in from --gtf (invalid file format?)"
-    print("# transcripts read in:  %i" % (len(tr2len_dic)))
 
+def write_transcripts_cache(in_gff, cache_dir):
+    tables = {chrom: {strand: transcript_arrays(chr_dict[chrom][strand]) for strand in chr_dict[chrom]}
+              for chrom in chr_dict}
+    write_annotation_cache(tables, cache_dir, in_gff)
 
 
-    print("Extract most prominent transcripts ... ")
+def read_gff_transcripts(in_gff):
+    """
+    Parse the GFF3 into chr_dict ({chrom: {strand: {transcript_id: transcript}}}, not sorted yet)
+    """
+    chr_dict.clear()
+    print("Extract most prominent transcripts and transcript lengths (exonic lengths) ... ")
 
     # Open GFF either as .gz or as text file.
-    if re.search(".+\.gz$", in_gff):
+    if GZ_RE.search(in_gff):
         f = gzip.open(in_gff, 'rt')
     else:
         f = open(in_gff, "r")
 
+    # Single pass: exon lengths are summed while the transcript models are built, and set on
+    # the transcripts once the whole file was read.
+    tr2len_dic = {}
+    chr_id_cache = {}
     t = time()
-    for i, line in enumerate(f):
+    n_lines = 0
+    for line in f:
+        n_lines += 1
         # Skip header.
-        if re.search("^#", line):
+        if line.startswith("#"):
             continue
         cols = line.strip().split("\t")
-        chr_id = cols[0]
         feature = cols[2]
-        feat_s = int(cols[3])
-        feat_e = int(cols[4])
-        feat_pol = cols[6]
-        infos = cols[8]
 
         # Take only transcripts and exons
         if feature not in ("transcript", "exon"):
             continue
+        chr_id = cols[0]
+        feat_s = int(cols[3])
+        feat_e = int(cols[4])
+        feat_pol = cols[6]
+        infos = parse_gff_attributes(cols[8])
+
+        tr_id = infos.get("transcript_id")
+        assert tr_id, "transcript_id entry missing in GFF file \"%s\", line \"%s\"" % (in_gff, line)
+
+        # Sum up exonic length (over all chromosomes).
+        if feature == "exon":
+            tr2len_dic[tr_id] = tr2len_dic.get(tr_id, 0) + feat_e - feat_s + 1
 
         # Restrict to standard chromosomes.
-        new_chr_id = check_convert_chr_id(chr_id)
-        if not new_chr_id:
+        if chr_id not in chr_id_cache:
+            chr_id_cache[chr_id] = check_convert_chr_id(chr_id)
+        if not chr_id_cache[chr_id]:
             continue
 
-        m = re.search('transcript_id=(.+?);', infos)
-        assert m, "transcript_id entry missing in GFF file \"%s\", line \"%s\"" % (in_gff, line)
-        tr_id = m.group(1)
-        m = re.search('gene_id=(.+?);', infos)
-        assert m, "transcript_id entry missing in GFF file \"%s\", line \"%s\"" % (in_gff, line)
-        gene_id = m.group(1)
-
-        # Transcript length.
-        tr_len = tr2len_dic[tr_id]
+        gene_id = infos.get("gene_id")
+        assert gene_id, "gene_id entry missing in GFF file \"%s\", line \"%s\"" % (in_gff, line)
 
         # Get transcript support level (TSL).
-        m = re.search('transcript_support_level=(.+?);', infos)
-        tsl_id = "NA"
-        if m:
-            tsl_id = m.group(1)
+        tsl_id = infos.get("transcript_support_level", "NA")
 
         # Add transcript
         if feature == "transcript":
             if chr_id not in chr_dict:
                 chr_dict[chr_id] = {"+": {}, "-": {}}
-            chr_dict[chr_id][feat_pol][tr_id] = transcript(tr_id, tr_len, feat_s, feat_e, tsl_id, gene_id, feat_pol)
+            chr_dict[chr_id][feat_pol][tr_id] = transcript(tr_id, None, feat_s, feat_e, tsl_id, gene_id, feat_pol)
         else:
             chr_dict[chr_id][feat_pol][tr_id].add_exon(feat_s, feat_e)
     f.close()
+    assert tr2len_dic, "No IDs read into dictionary (input file \"%s\" empty or malformatted?)" % (in_gff)
 
-    print(f"Done reading lines - {round((time()-t))}s")
-
-    print("Sorting transcripts")
-    t = time()
-    sort_transcripts()
-    print(f"Done Sorting - {round((time()-t))}s")
-
+    # Transcript length.
+    for chrom in chr_dict:
+        for strand in chr_dict[chrom]:
+            for tr_id, tr in chr_dict[chrom][strand].items():
+                tr.len = tr2len_dic[tr_id]
 
-    with open(f'{out_dir}/transcripts_locations.pkl', 'wb') as f:
-        pickle.dump(chr_dict, f)
+    elapsed = time() - t
+    print("# transcripts read in:  %i" % (len(tr2len_dic)))
+    print(f"Done reading lines - {round(elapsed)}s ({n_lines / max(elapsed, 1e-9):,.0f} lines/s)")
+    return n_lines
 
 
-def get_transcript_and_position(pos_list, tr_list, rsr_list, reads_list, strand):
+def transcript_arrays(tr_list):
     """
-     Assumption: chromosome coordinates are sorted in ascending order
+    Columnar view of a sorted transcript list: per transcript names, genes, starts, ends, tsl and
+    lengths, plus CSR style exons (exon_ptr offsets into exon_starts / exon_ends, in exon order).
     """
-    prominent_tr_idx = None
-    tr_idx = 0
-    pos_idx = 0
-    no_match_sum = 0
-    rts_locations = []
-
-    first_match_idx = None
-    while pos_idx < len(pos_list):
-        # stop if transcript list ended
-        if tr_idx >= len(tr_list):
-            no_match_sum += len(pos_list[pos_idx:])
-            break
-
-        # If current transcript starts after current position
-        if tr_list[tr_idx].start > pos_list[pos_idx]:
-            # If current position had already match transcript
-            if first_match_idx is not None:
-                start_point = 0
-                found_exon = False
-                for exon_range in tr_list[prominent_tr_idx].exons_ranges:
-                    if not exon_range[0] < pos_list[pos_idx] < exon_range[1]:
-                        start_point += exon_range[1] - exon_range[0] + 1
-                    else:
-                        found_exon = True
-                        if strand == "+":
-                            start_point += pos_list[pos_idx] - exon_range[0] + 1
-                        else:
-                            start_point += exon_range[1] - pos_list[pos_idx] + 1
-                        break
-                if not found_exon:
-                    print("ERROR: Didn't found exon")
-                else:
-                    spliced = 1 if len(tr_list[prominent_tr_idx].exons_ranges) > 1 else 0
-                    rts_locations.append([tr_list[prominent_tr_idx].name, start_point,
-                                          rsr_list[pos_idx], reads_list[pos_idx], spliced])
-                tr_idx = first_match_idx
-                first_match_idx = None
-                prominent_tr_idx = None
-            # If current position had no matched transcripts
-            else:
-                no_match_sum += 1
-                # print(f"No match for {chrom}-{pos_list[pos_idx]}")
-            # next position
-            pos_idx += 1
-            continue
-
-        # If current transcript ends before current position
-        if tr_list[tr_idx].end < pos_list[pos_idx]:
-            tr_idx += 1
-            continue
-
-
-        # check if pos is overlapping any exon
-        over_lapping_exon = False
-        for exon_range in tr_list[tr_idx].exons_ranges:
-            if exon_range[0] < pos_list[pos_idx] < exon_range[1]:
-                over_lapping_exon = True
-                # print("find overlapping trans:")
-                # print(tr_list[tr_idx])
+    n_exons = np.array([len(tr.exons_ranges) for tr in tr_list], dtype=np.int64)
+    exon_ptr = np.zeros(len(tr_list) + 1, dtype=np.int64)
+    np.cumsum(n_exons, out=exon_ptr[1:])
+    ranges = np.array([r for tr in tr_list for r in tr.exons_ranges], dtype=np.int64).reshape(-1, 2)
+    return {"names": np.array([tr.name for tr in tr_list], dtype=str),
+            "genes": np.array([tr.gene for tr in tr_list], dtype=str),
+            "starts": np.array([tr.start for tr in tr_list], dtype=np.int64),
+            "ends": np.array([tr.end for tr in tr_list], dtype=np.int64),
+            "tsl": np.array([tr.tsl for tr in tr_list], dtype=np.int64),
+            "lens": np.array([tr.len for tr in tr_list], dtype=np.int64),
+            "exon_ptr": exon_ptr,
+            "exon_starts": ranges[:, 0].copy(),
+            "exon_ends": ranges[:, 1].copy()}
+
+
+class TranscriptIndex:
+    """
+    NumPy backed interval index over the transcripts (and their exons) of one chromosome strand.
+    Built once per chromosome and strand, answers the most prominent transcript and spliced offset
+    for a whole vector of positions.
+    """
+    def __init__(self, arrays, strand):
+        """
+        arrays: columnar transcripts of one chromosome strand, as returned by transcript_arrays
+        (or loaded from an annotation cache)
+        """
+        self.strand = strand
+        self.names = np.asarray(arrays["names"])
+        self.starts = np.asarray(arrays["starts"], dtype=np.int64)
+        self.ends = np.asarray(arrays["ends"], dtype=np.int64)
+        self.tsl = np.asarray(arrays["tsl"], dtype=np.int64)
+        self.lens = np.asarray(arrays["lens"], dtype=np.int64)
+        ex_ptr = np.asarray(arrays["exon_ptr"], dtype=np.int64)
+        ranges = np.stack([np.asarray(arrays["exon_starts"], dtype=np.int64),
+                           np.asarray(arrays["exon_ends"], dtype=np.int64)], axis=1)
+        n_tr = len(self.starts)
+        n_exons = np.diff(ex_ptr)
+        self.spliced = (n_exons > 1).astype(np.int64)
+        # prominence rank: lowest tsl, then longest, then last in list order
+        self.rank = np.empty(n_tr, dtype=np.int64)
+        self.rank[np.lexsort((np.arange(n_tr), self.lens, -self.tsl))] = np.arange(n_tr)
+
+        # flat exon table, spliced length before (in transcript exon order) every exon
+        ex_tr = np.repeat(np.arange(n_tr, dtype=np.int64), n_exons)
+        ex_len = ranges[:, 1] - ranges[:, 0] + 1
+        cum_len = np.concatenate([[0], np.cumsum(ex_len)])
+        ex_before = cum_len[:-1] - cum_len[ex_ptr[:-1]][ex_tr]
+
+        # exons bucketed by length class (powers of 2) and sorted by start inside every bucket, so a
+        # stabbing query only scans exons starting less than the bucket's max length before it
+        ex_class = np.floor(np.log2(np.maximum(ex_len, 1))).astype(np.int64)
+        order = np.lexsort((ranges[:, 0], ex_class))
+        self.ex_tr = ex_tr[order]
+        self.ex_start = ranges[order, 0]
+        self.ex_end = ranges[order, 1]
+        self.ex_before = ex_before[order]
+        classes, bounds = np.unique(ex_class[order], return_index=True)
+        self.buckets = [(b, e, 2 ** (c + 1)) for c, b, e in zip(classes, bounds, np.r_[bounds[1:], len(order)])]
+
+    def candidates(self, pos):
+        """
+        All (position index, transcript index, exon index) triplets where the position lies strictly
+        inside an exon of a transcript, sorted by position then transcript index.
+        """
+        pos = np.asarray(pos, dtype=np.int64)
+        lo, counts = [], []
+        for b, e, max_len in self.buckets:
+            starts = self.ex_start[b:e]
+            b_lo = b + np.searchsorted(starts, pos - max_len, side='right')
+            lo.append(b_lo)
+            counts.append(b + np.searchsorted(starts, pos, side='left') - b_lo)
+        lo = np.concatenate(lo) if lo else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+        pos_idx = np.repeat(np.tile(np.arange(len(pos), dtype=np.int64), len(self.buckets)), counts)
+        ex_idx = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        p = pos[pos_idx]
+        tr_idx = self.ex_tr[ex_idx]
+        keep = (self.ex_end[ex_idx] > p) & (self.starts[tr_idx] <= p) & (self.ends[tr_idx] >= p)
+        pos_idx, tr_idx, ex_idx = pos_idx[keep], tr_idx[keep], ex_idx[keep]
+        order = np.lexsort((tr_idx, pos_idx))
+        return pos_idx[order], tr_idx[order], ex_idx[order]
+
+    def spliced_offset(self, pos, ex_idx):
+        if self.strand == "+":
+            return self.ex_before[ex_idx] + pos - self.ex_start[ex_idx] + 1
+        return self.ex_before[ex_idx] + self.ex_end[ex_idx] - pos + 1
+
+    def query(self, pos):
+        """
+        Return (transcript index, spliced offset) per position, transcript index -1 for no match.
+        Follows the scan semantics: positions in input order, a transcript cursor that restarts from
+        the first match of the previous position, and no matches once every transcript starts
+        at or before the position.
+        """
+        pos = np.asarray(pos, dtype=np.int64)
+        n_pos, n_tr = len(pos), len(self.starts)
+        pos_idx, tr_idx, ex_idx = self.candidates(pos)
+        ptr = np.searchsorted(pos_idx, np.arange(n_pos + 1))
+
+        cand_tr, cand_rank = tr_idx.tolist(), self.rank[tr_idx].tolist()
+        upper = np.searchsorted(self.starts, pos, side='right').tolist()
+        ptr = ptr.tolist()
+
+        chosen = [-1] * n_pos
+        cursor = 0
+        for i in range(n_pos):
+            if upper[i] >= n_tr:
                 break
-        if not over_lapping_exon:
-            tr_idx += 1
-            continue
+            # candidates the cursor has already passed are skipped, like in the scan
+            first = bisect_left(cand_tr, cursor, ptr[i], ptr[i+1])
+            if first == ptr[i+1]:
+                cursor = upper[i]
+                continue
+            best = first
+            for j in range(first + 1, ptr[i+1]):
+                if cand_rank[j] > cand_rank[best]:
+                    best = j
+            chosen[i] = best
+            cursor = cand_tr[first]
+
+        chosen = np.array(chosen, dtype=np.int64)
+        matched = chosen >= 0
+        tr_out = np.full(n_pos, -1, dtype=np.int64)
+        offsets = np.zeros(n_pos, dtype=np.int64)
+        tr_out[matched] = tr_idx[chosen[matched]]
+        offsets[matched] = self.spliced_offset(pos[matched], ex_idx[chosen[matched]])
+        return tr_out, offsets
+
+
+def get_transcript_and_position(pos_list, tr_list, rsr_list, reads_list, strand, index=None):
+    """
+    Most prominent transcript and spliced position for every position, as one batched
+    TranscriptIndex query (pass a prebuilt index to reuse it across calls).
+    Assumption: chromosome coordinates are sorted in ascending order
+    """
+    index = TranscriptIndex(transcript_arrays(tr_list), strand) if index is None else index
+    tr_idx, offsets = index.query(pos_list)
+    matched = np.nonzero(tr_idx >= 0)[0]
+    print(f"No matched positions = {len(pos_list) - len(matched)}/{len(pos_list)}")
+    return pd.DataFrame({"transcript": index.names[tr_idx[matched]],
+                         "position": offsets[matched],
+                         "rsr": np.asarray(rsr_list)[matched],
+                         "total_reads": np.asarray(reads_list)[matched],
+                         "splice": index.spliced[tr_idx[matched]]})
+
 
-        # check for prominent transcript
-        if first_match_idx is None:
-            first_match_idx = tr_idx
-            prominent_tr_idx = tr_idx
-        # prominent transcript if tsl is lower, in case of equality, longer is prominent
-        elif tr_list[tr_idx].tsl <= tr_list[prominent_tr_idx].tsl and not \
-                (tr_list[tr_idx].tsl == tr_list[prominent_tr_idx].tsl and
-                 tr_list[tr_idx].len < tr_list[prominent_tr_idx].len):
-            prominent_tr_idx = tr_idx
+_annotations = {}
 
-        tr_idx += 1
-    print(f"No matched positions = {no_match_sum}/{len(pos_list)}")
-    return pd.DataFrame(rts_locations, columns=["transcript", "position", "rsr", "total_reads", "splice"])
 
+def map_positions_shard(cache_dir, chrom, strand, pos_list, rsr_list, reads_list):
+    """
+    Process pool worker for one chromosome strand: the transcripts are memory mapped from the
+    annotation cache in cache_dir rather than pickled to every worker.
+    """
+    if cache_dir not in _annotations:
+        _annotations[cache_dir] = AnnotationCache(cache_dir)
+    index = TranscriptIndex(_annotations[cache_dir].table(chrom, strand), strand)
+    return get_transcript_and_position(pos_list, None, rsr_list, reads_list, strand, index=index)
 
 
 if __name__ == "__main__":
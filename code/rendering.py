@@ -0,0 +1,46 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+
+'''
+Figure rendering helpers shared by the plotting scripts: a headless (Agg) mode for batch nodes, deterministic
+figure closing and rendering of independent figures in a process pool.
+'''
+
+
+def set_headless(headless=True):
+    # non-interactive backend, figures are only saved and plt.show() never blocks
+    if headless:
+        plt.switch_backend('Agg')
+
+
+def is_headless():
+    return matplotlib.get_backend().lower() == 'agg'
+
+
+def finish_figure(fig, path):
+    """
+    Save fig to path, show it when running interactively, and close it.
+    """
+    fig.savefig(path)
+    if not is_headless():
+        plt.show()
+    plt.close(fig)
+
+
+def _init_worker():
+    plt.switch_backend('Agg')
+
+
+def render_all(render, jobs, workers=1):
+    """
+    Call render(*job) for every job of jobs, each drawing and finishing one independent figure.
+    In headless mode with workers > 1 the figures are rendered in a process pool, so memory stays flat
+    (every figure is closed once saved) and rendering scales with the cores.
+    """
+    jobs = list(jobs)
+    if workers > 1 and len(jobs) > 1 and is_headless():
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            return list(pool.map(render, *zip(*jobs), chunksize=max(1, len(jobs) // (4 * workers))))
+    return [render(*job) for job in jobs]
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from encoding import WIN_SIZE, encode_codes
+from fasta_io import iter_fasta, chunked
+
+'''
+Pre-encoded sequence store, built once per FASTA file and memory mapped by the inference scripts.
+A store is a directory with:
+    seqs.npy     - (n,) fixed width bytes array of the upper case sequences
+    codes.npy    - (n, win) uint8 G4detector class codes (center-cropped / N-padded to win)
+    headers.txt  - one FASTA description per line
+    meta.json    - source file, number of sequences, width and win
+'''
+
+META_FILE = 'meta.json'
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def build_store(fasta_path, store_dir, win=WIN_SIZE, chunk_size=100000):
+    """
+    Encode fasta_path into a sequence store under store_dir with bounded memory (two passes).
+    """
+    n, width = 0, 1
+    for _, seq in iter_fasta(fasta_path):
+        n += 1
+        width = max(width, len(seq))
+
+    os.makedirs(store_dir, exist_ok=True)
+    seqs = np.lib.format.open_memmap(os.path.join(store_dir, 'seqs.npy'), mode='w+', dtype=f'S{width}', shape=(n,))
+    codes = np.lib.format.open_memmap(os.path.join(store_dir, 'codes.npy'), mode='w+', dtype=np.uint8, shape=(n, win))
+    start = 0
+    with open(os.path.join(store_dir, 'headers.txt'), 'w') as f:
+        for chunk in chunked(iter_fasta(fasta_path), chunk_size):
+            stop = start + len(chunk)
+            f.write(''.join(f"{desc}\n" for desc, _ in chunk))
+            seqs[start:stop] = [seq.upper().encode('ascii') for _, seq in chunk]
+            encode_codes(seqs[start:stop], win, out=codes[start:stop])
+            start = stop
+    seqs.flush()
+    codes.flush()
+    del seqs, codes
+
+    with open(os.path.join(store_dir, META_FILE), 'w') as f:
+        json.dump({'source': os.path.abspath(fasta_path), 'n': n, 'width': width, 'win': win}, f)
+    print(f"Stored {n} sequences (width {width}) in {store_dir}")
+
+
+class SeqStore:
+    """
+    Read only, zero-copy view of a sequence store.
+    """
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.seqs = np.load(os.path.join(store_dir, 'seqs.npy'), mmap_mode='r')
+        self.codes = np.load(os.path.join(store_dir, 'codes.npy'), mmap_mode='r')
+        with open(os.path.join(store_dir, 'headers.txt')) as f:
+            self.headers = f.read().splitlines()
+        assert len(self.headers) == len(self.seqs) == len(self.codes) == self.meta['n'], \
+            f"Corrupted sequence store {store_dir}"
+
+    def __len__(self):
+        return self.meta['n']
+
+    @property
+    def win(self):
+        return self.meta['win']
+
+    def strings(self, start=0, stop=None):
+        return [s.decode('ascii') for s in self.seqs[start:stop]]
+
+    def code_chunks(self, chunk_size):
+        for start in range(0, len(self), chunk_size):
+            yield self.codes[start:start + chunk_size]
+
+    def record_chunks(self, chunk_size):
+        for start in range(0, len(self), chunk_size):
+            stop = start + chunk_size
+            yield list(zip(self.headers[start:stop], self.strings(start, stop)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta', help='Path to fasta file')
+    parser.add_argument('store', help='Output sequence store directory')
+    parser.add_argument('-w', '--win', default=WIN_SIZE, type=int, help=f'G4detector window size (default {WIN_SIZE})')
+    args = parser.parse_args()
+
+    build_store(args.fasta, args.store, args.win)